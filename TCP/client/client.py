@@ -1,12 +1,62 @@
 import argparse
+import bz2
+import hashlib
+import json
+import lzma
 import socket
+import struct
+import sys
 import threading
 import os
 import time
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm  
 
+# The code shared by the servers and the clients lives in common/, at the top of the project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.files import merkle_root
+from common.metrics import Metrics
+from common.pacing import TokenBucket
+
 DOWNLOAD_DIR = "downloads"
 INPUT_FILE = "input.txt"  # wanted files
+
+# Framed protocol (see server.py): requests are <length:u32><command text>,
+# responses are <status:u8><length:u64><body>
+REQUEST_HEADER = struct.Struct("!I")
+RESPONSE_HEADER = struct.Struct("!BQ")
+STATUS_OK = 0
+RECV_SIZE = 64 * 1024
+RECV_BUFFER_SIZE = 1024 * 1024  # recv_into buffer of each range worker
+WRITE_MODES = ("direct", "parts")
+MAX_SESSIONS = 8          # Idle sessions kept open per server
+PIPELINE_BLOCK = 1024 * 1024  # Bytes asked for by one DOWNLOAD request until the stream rate is known
+PIPELINE_DEPTH = 4        # DOWNLOAD requests kept in flight on one session
+MIN_REQUEST_SIZE = 256 * 1024
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+TARGET_REQUEST_TIME = 0.25  # Seconds of data asked for by one DOWNLOAD request
+MAX_STREAMS = 8           # Parallel streams per file
+MIN_SEGMENT_SIZE = 1024 * 1024  # Don't open a stream for less than this
+MIN_SEGMENT_TIME = 1.0    # ... or for less than this many seconds of work at the measured rate
+MIN_STEAL_SIZE = 512 * 1024  # Tails smaller than twice this are not split
+STEAL_MIN_TIME = 0.5      # Tails finishing sooner than this are not split
+MAX_FAILURES = 10         # Stream errors tolerated per file
+MANIFEST_INTERVAL = 1.0   # Seconds between two saves of a download manifest
+MAX_FILES = 4             # Files downloaded at the same time
+MAX_CONNECTIONS = 16      # Streams open at the same time, over all files
+MAX_INFLIGHT = 256 * 1024 * 1024  # Bytes requested but not yet received, over all files
+PRIORITIES = ("smallest", "input")
+VERIFY_THREADS = 4        # Blocks hashed in parallel by --verify and --update
+MAX_BLOCK_RETRIES = 2     # Times the blocks that fail verification are downloaded again
+COMPRESS_BLOCK = 256 * 1024  # The server compresses (and caches) blocks at these file offsets
+# Frame of a compressed DOWNLOAD response: codec id (0 = raw), raw length, payload length
+FRAME_HEADER = struct.Struct("!BII")
+Codec = namedtuple("Codec", ["id", "decompress"])
+# Compression codecs the client can ask for, by name (see COMPRESS), and by id on the wire
+CODECS = {"zlib": Codec(1, zlib.decompress), "bz2": Codec(2, bz2.decompress), "lzma": Codec(3, lzma.decompress)}
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
 socket_art = """
     ████████╗ ██████╗██████╗     
     ╚══██╔══╝██╔════╝██╔══██╗    
@@ -24,23 +74,124 @@ socket_art = """
      """
 # A set to avoid redownload file
 downloaded_files = set()
+# Session pools, one per (host, port)
+session_pools = {}
+# Serialises seek+write on platforms without os.pwrite
+write_lock = threading.Lock()
+# Running estimate of the throughput of a single stream (bytes/s), 0 until measured
+measured_stream_rate = 0.0
+
+class ProtocolError(Exception):
+    """Raised when the server answers a request with an error response."""
+
+class Session:
+    """
+    A persistent connection to the server carrying framed requests.
+    Requests can be pipelined: send several, then read the responses in the same order.
+    """
+    def __init__(self, server_host, server_port):
+        self.sock = socket.create_connection((server_host, server_port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send_request(self, request):
+        payload = request.encode()
+        self.sock.sendall(REQUEST_HEADER.pack(len(payload)) + payload)
+
+    def recv_exact(self, size):
+        buffer = bytearray()
+        while len(buffer) < size:
+            data = self.sock.recv(min(size - len(buffer), RECV_SIZE))
+            if not data:
+                raise ConnectionError("Server closed the session")
+            buffer += data
+        return bytes(buffer)
+
+    def recv_response_header(self):
+        """Read the next response header, returns the body length (raises ProtocolError on error responses)."""
+        status, length = RESPONSE_HEADER.unpack(self.recv_exact(RESPONSE_HEADER.size))
+        if status != STATUS_OK:
+            raise ProtocolError(self.recv_exact(length).decode(errors="replace"))
+        return length
+
+    def recv_into_exact(self, buffer, size):
+        """Fill buffer[:size] with the next size bytes of the current response."""
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            n = self.sock.recv_into(view[received:size])
+            if not n:
+                raise ConnectionError("Server closed the session")
+            received += n
+
+    def request(self, request):
+        """Send one request and return the whole response body."""
+        self.send_request(request)
+        return self.recv_exact(self.recv_response_header())
+
+    def close(self):
+        self.sock.close()
+
+class SessionPool:
+    """Keep a few idle sessions per server so that requests reuse open connections."""
+    def __init__(self, server_host, server_port, max_idle=MAX_SESSIONS):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return Session(self.server_host, self.server_port)
+
+    def release(self, session, reuse=True):
+        """Give a session back; sessions left in an unknown state must not be reused."""
+        with self.lock:
+            if reuse and len(self.idle) < self.max_idle:
+                self.idle.append(session)
+                return
+        session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for session in sessions:
+            session.close()
+
+def get_session_pool(server_host, server_port):
+    """Return the shared session pool for a server."""
+    key = (server_host, server_port)
+    if key not in session_pools:
+        session_pools[key] = SessionPool(server_host, server_port)
+    return session_pools[key]
+
+def pool_request(server_host, server_port, request):
+    """Send one request over a pooled session and return the response body."""
+    pool = get_session_pool(server_host, server_port)
+    session = pool.acquire()
+    try:
+        body = session.request(request)
+    except ProtocolError:
+        pool.release(session)  # the error response was read in full, the session is fine
+        raise
+    except Exception:
+        pool.release(session, reuse=False)
+        raise
+    pool.release(session)
+    return body
 
 def fetch_file_list(server_host, server_port):
     """
-    Send a LIST command for server, server then gives the client the file_list.txt which will be parsed for filenames and their sizes
+    Send a LIST command for server, server then gives the client the file_list.txt which will be parsed
+    for filenames and their sizes
     """
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((server_host, server_port))
-    client.sendall(b"LIST")  # LIST command
-    
+    file_list = pool_request(server_host, server_port, "LIST")  # LIST command
+
     # Client recieves file_list.txt
     with open("file_list.txt", "wb") as f:
-        while True:
-            data = client.recv(1024)
-            if not data:
-                break
-            f.write(data)
-    client.close()
+        f.write(file_list)
 
     # Parse file_list.txt to obtain filenames and their sizes
     
@@ -51,6 +202,210 @@ def fetch_file_list(server_host, server_port):
             files[filename] = int(size)  # Update dictionary
     return files
 
+def fetch_file_stat(server_host, server_port, filename):
+    """Ask the server for the (size, mtime) of a file."""
+    size, mtime = pool_request(server_host, server_port, f"STAT {filename}").split()
+    return int(size), int(mtime)
+
+# SHA-256 of every block of a file (leaves) and the root of the Merkle tree over them
+BlockManifest = namedtuple("BlockManifest", ["size", "mtime", "block_size", "leaves", "root"])
+
+def fetch_block_manifest(server_host, server_port, filename):
+    """
+    Ask the server for the block manifest of a file (BLOCKS), None if the server doesn't have
+    it or the block hashes don't add up to the announced Merkle root.
+    """
+    try:
+        body = pool_request(server_host, server_port, f"BLOCKS {filename}")
+    except ProtocolError:
+        return None
+    header, *lines = body.decode().split("\n")
+    size, mtime, block_size, count, root = header.split()
+    leaves = [bytes.fromhex(line) for line in lines if line]
+    if len(leaves) != int(count) or merkle_root(leaves).hex() != root:
+        return None
+    return BlockManifest(int(size), int(mtime), int(block_size), leaves, bytes.fromhex(root))
+
+def fetch_codec(server_host, server_port, codec):
+    """
+    Agree on a compression codec for DOWNLOAD: codec is offered first, then the others.
+    Returns the one the server picked, None when it compresses nothing.
+    """
+    offered = [codec] + [name for name in CODECS if name != codec]
+    try:
+        chosen = pool_request(server_host, server_port, f"COMPRESS {','.join(offered)}").decode()
+    except ProtocolError:
+        return None  # server without compression
+    return chosen if chosen in CODECS else None
+
+def recv_raw(session, buffer, length):
+    """Receive a DOWNLOAD response body into buffer: yields (data, bytes received) pieces."""
+    while length > 0:
+        n = min(length, len(buffer))
+        session.recv_into_exact(buffer, n)
+        yield memoryview(buffer)[:n], n
+        length -= n
+
+def recv_frames(session, buffer, length):
+    """
+    Receive a compressed DOWNLOAD response body frame by frame: yields (data, bytes received),
+    data being the decompressed frame.
+    """
+    while length > 0:
+        codec_id, raw_length, size = FRAME_HEADER.unpack(session.recv_exact(FRAME_HEADER.size))
+        if size > len(buffer):
+            raise ConnectionError(f"frame of {size} bytes is larger than the receive buffer")
+        session.recv_into_exact(buffer, size)
+        if codec_id == 0:
+            data = memoryview(buffer)[:size]
+        elif codec_id not in CODEC_IDS:
+            raise ProtocolError(f"frame with unknown codec id {codec_id}")
+        else:
+            try:
+                data = CODEC_IDS[codec_id].decompress(buffer[:size])
+            except (zlib.error, OSError, ValueError, lzma.LZMAError) as e:
+                raise ProtocolError(f"corrupt frame: {e}")
+        if len(data) != raw_length:
+            raise ConnectionError(f"frame decompressed to {len(data)} bytes instead of {raw_length}")
+        yield data, FRAME_HEADER.size + size
+        length -= FRAME_HEADER.size + size
+
+def merge_ranges(ranges):
+    """Sort byte ranges and merge the ones that touch or overlap."""
+    merged = []
+    for start, end in sorted(tuple(r) for r in ranges):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(done, size):
+    """Byte ranges of [0, size) not covered by the merged ranges in done."""
+    missing = []
+    position = 0
+    for start, end in done:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+def remove_ranges(done, removed, size):
+    """The merged ranges in done, without the bytes covered by removed."""
+    return [list(r) for r in missing_ranges(merge_ranges(missing_ranges(done, size) + list(removed)), size)]
+
+def manifest_path(filename):
+    return os.path.join(DOWNLOAD_DIR, f"{filename}.partial.json")
+
+def load_manifest(filename, size, mtime):
+    """
+    Return the byte ranges already downloaded into <filename>.partial, or [] when there is
+    no manifest or the file changed on the server since (different size or mtime).
+    """
+    try:
+        with open(manifest_path(filename), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if manifest.get("size") != size or manifest.get("mtime") != mtime:
+        print(f"[!] {filename} changed on the server, restarting download")
+        return []
+    return merge_ranges(manifest.get("done", []))
+
+def save_manifest(filename, size, mtime, done):
+    """Atomically record the completed byte ranges of a partial download."""
+    path = manifest_path(filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"size": size, "mtime": mtime, "done": done}, f)
+    os.replace(path + ".tmp", path)
+
+def remove_manifest(filename):
+    try:
+        os.remove(manifest_path(filename))
+    except FileNotFoundError:
+        pass
+
+def block_matches(path, manifest, block):
+    """Whether a block of the local file at path has the SHA-256 listed in manifest."""
+    start = block * manifest.block_size
+    length = min(manifest.block_size, manifest.size - start)
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(length)
+    return len(data) == length and hashlib.sha256(data).digest() == manifest.leaves[block]
+
+class BlockVerifier:
+    """
+    Check a download against the server's block manifest while it is written: add() records
+    the byte ranges written to the partial file, and every block they complete is read back
+    and hashed on a thread pool, in parallel with the transfer. Blocks already complete in
+    done (resumed, or reused by --update) are not checked again.
+    """
+    def __init__(self, path, manifest, done=()):
+        self.path = path
+        self.manifest = manifest
+        self.coverage = {}     # block -> merged ranges written so far, while incomplete
+        self.complete = set()  # blocks checked or being checked
+        self.bad = []          # byte ranges of the blocks that didn't match
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=VERIFY_THREADS)
+        for start, end in done:
+            self.add(start, end, check=False)
+
+    def add(self, start, end, check=True):
+        """Record that [start, end) was written, queue the blocks it completes for hashing."""
+        block_size = self.manifest.block_size
+        with self.lock:
+            for block in range(start // block_size, -(-end // block_size)):
+                if block in self.complete:
+                    continue
+                low = block * block_size
+                high = min(low + block_size, self.manifest.size)
+                covered = merge_ranges(self.coverage.get(block, []) + [(max(start, low), min(end, high))])
+                if covered == [[low, high]]:
+                    self.coverage.pop(block, None)
+                    self.complete.add(block)
+                    if check:
+                        self.pool.submit(self.check, block)
+                else:
+                    self.coverage[block] = covered
+
+    def check(self, block):
+        if not block_matches(self.path, self.manifest, block):
+            low = block * self.manifest.block_size
+            with self.lock:
+                self.bad.append((low, min(low + self.manifest.block_size, self.manifest.size)))
+
+    def finish(self):
+        """Wait for the queued checks, returns the merged byte ranges of the blocks that failed."""
+        self.pool.shutdown(wait=True)
+        return merge_ranges(self.bad)
+
+def reuse_local_copy(filename, manifest):
+    """
+    Turn downloads/<filename> into a partial download of the server's version described by
+    manifest: its blocks are hashed in parallel and the ones that match are recorded as
+    downloaded, so only the blocks that differ are fetched. Returns the number of bytes reused,
+    None when the local copy is already up to date (and is left alone).
+    """
+    local_path = os.path.join(DOWNLOAD_DIR, filename)
+    with ThreadPoolExecutor(max_workers=VERIFY_THREADS) as pool:
+        matches = list(pool.map(lambda block: block_matches(local_path, manifest, block), range(len(manifest.leaves))))
+    if all(matches) and os.path.getsize(local_path) == manifest.size:
+        return None
+    block_size = manifest.block_size
+    reused = merge_ranges((block * block_size, min((block + 1) * block_size, manifest.size))
+                          for block, match in enumerate(matches) if match)
+    partial_path = os.path.join(DOWNLOAD_DIR, f"{filename}.partial")
+    os.replace(local_path, partial_path)
+    os.truncate(partial_path, manifest.size)
+    save_manifest(filename, manifest.size, manifest.mtime, reused)
+    return sum(end - start for start, end in reused)
+
 def read_input_file():
     """
     Read INPUT_FILE and get wanted filenames
@@ -99,79 +454,527 @@ def display_available_files(files):
     print(f"{BOLD}Total Files: {len(files)}{RESET}")
     print(f"\nTo download: Add filenames to input.txt, one per line.\n")
 
-def download_chunk(filename, offset, chunk_size, part, total_parts, server_host, server_port):
+def write_at(fd, data, position):
+    """Write all of data at position in fd, without sharing a file pointer between threads."""
+    if not hasattr(os, "pwrite"):
+        with write_lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+        return
+    while data:
+        n = os.pwrite(fd, data, position)
+        data = data[n:]
+        position += n
+
+def preallocate(fd, size):
+    """Reserve size bytes for the destination file so range workers can write anywhere in it."""
+    if size == 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # Filesystem without fallocate support
+    os.ftruncate(fd, size)
+
+# Counters and latency histograms of the downloads, written by --metrics
+metrics = Metrics("tcp_client_")
+
+def save_metrics(path):
+    """Write the metrics to path: Prometheus text for a .prom file, JSON otherwise."""
+    with open(path, "w") as f:
+        f.write(metrics.render("prometheus" if path.endswith(".prom") else "json"))
+
+class TransferBudget:
+    """Global limits shared by every running download: open streams, bytes in flight and bandwidth."""
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_inflight=MAX_INFLIGHT, rate=0):
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.bytes_received = 0
+        self.cond = threading.Condition()
+        self.bucket = TokenBucket(rate)
+
+    def reserve(self, n, block=True):
+        """Account for a request of n bytes; False if it doesn't fit and block is False."""
+        with self.cond:
+            # A single request larger than the budget still goes through on its own
+            while self.inflight and self.inflight + n > self.max_inflight:
+                if not block:
+                    return False
+                self.cond.wait()
+            self.inflight += n
+            return True
+
+    def release(self, n):
+        with self.cond:
+            self.inflight -= n
+            self.cond.notify_all()
+
+    def received(self, n):
+        """Count n received bytes, sleeping if that goes over the bandwidth limit."""
+        with self.cond:
+            self.bytes_received += n
+        self.bucket.consume(n)
+
+class Segment:
+    """A byte range [start, end) of a file, worked on by one stream at a time."""
+    def __init__(self, part, start, end):
+        self.part = part          # part number, used for part files
+        self.start = start
+        self.requested = start    # next byte to ask the server for
+        self.done = start         # every byte before this is written
+        self.end = end            # shrinks when an idle stream steals the tail
+        self.rate = 0.0           # measured bytes/s of the stream working on it
+
+    def remaining_time(self):
+        if self.rate <= 0:
+            return float("inf")
+        return (self.end - self.done) / self.rate
+
+class RangeScheduler:
     """
-    Client sends a DOWNLOAD command with arguments : filename, chunksize, partNumber, totalPart
-    Server will begins downloading the requested chunk(s)
+    Hand out byte ranges of one file to stream workers.
+    The file starts as a few segments sized from the file size and the measured per-stream
+    throughput; a worker without a segment steals the unrequested half of the segment that
+    is expected to finish last, so one slow stream can't hold up the whole file.
+    With align, segments and requests start and end on multiples of align where possible
+    (compressed transfers then ask for whole blocks of the server's compression cache).
     """
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((server_host, server_port))
-    client.sendall(f"DOWNLOAD {filename} {offset} {chunk_size}".encode())
-    
-    # Create temporary part files
-    with open(f"{DOWNLOAD_DIR}/{filename}.part{part}", "wb") as f:
-        with tqdm(total=chunk_size, unit="B", unit_scale=True, desc=f"{filename} part {part}/{total_parts}", leave=True) as pbar:
+    def __init__(self, ranges, max_streams, done=(), align=1):
+        self.done = [tuple(r) for r in done]  # ranges completed by an earlier run
+        self.align = align
+        total = sum(end - start for start, end in ranges)
+        self.streams = plan_stream_count(total, max_streams)
+        segment_size = -(-max(1, -(-total // self.streams)) // align) * align
+        self.pending = deque()
+        self.segments = []  # every segment handed out so far
+        for start, end in ranges:
+            for offset in range(start, end, segment_size):
+                self.pending.append((offset, min(offset + segment_size, end)))
+        self.active = set()
+        self.failures = 0
+        self.aborted = False
+        self.lock = threading.Lock()
+
+    def next_segment(self, rate):
+        """Give an idle worker a pending segment, or steal one; None when nothing is left."""
+        with self.lock:
+            if self.aborted:
+                return None
+            if self.pending:
+                start, end = self.pending.popleft()
+            else:
+                victim = max(self.active, key=Segment.remaining_time, default=None)
+                if victim is None:
+                    return None
+                unrequested = victim.end - victim.requested
+                if unrequested < 2 * MIN_STEAL_SIZE:
+                    return None
+                if rate > 0 and victim.rate > 0 and unrequested / victim.rate < STEAL_MIN_TIME:
+                    return None  # the tail will be done before a new stream gets going
+                start, end = victim.requested + unrequested // 2, victim.end
+                start -= start % self.align  # still above victim.requested: unrequested // 2 >= MIN_STEAL_SIZE > align
+                victim.end = start
+            segment = Segment(len(self.segments) + 1, start, end)
+            segment.rate = rate
+            self.segments.append(segment)
+            self.active.add(segment)
+            return segment
+
+    def next_request(self, segment):
+        """Reserve the next (offset, size) of segment to request, sized to about TARGET_REQUEST_TIME of data."""
+        with self.lock:
+            if segment.requested >= segment.end:
+                return None
+            size = PIPELINE_BLOCK
+            if segment.rate > 0:
+                size = int(min(MAX_REQUEST_SIZE, max(MIN_REQUEST_SIZE, segment.rate * TARGET_REQUEST_TIME)))
+            offset = segment.requested
+            size = min(size, segment.end - offset)
+            if offset + size < segment.end:
+                # End on a boundary, at least the next one
+                size = max((offset + size) // self.align * self.align, (offset // self.align + 1) * self.align) - offset
+                size = min(size, segment.end - offset)
+            segment.requested += size
+            return offset, size
+
+    def advance(self, segment, n, rate):
+        with self.lock:
+            segment.done += n
+            segment.rate = rate
+
+    def finish(self, segment):
+        with self.lock:
+            self.active.discard(segment)
+
+    def completed_ranges(self):
+        """Merged byte ranges written so far, including those of an earlier run."""
+        with self.lock:
+            ranges = self.done + [(s.start, s.done) for s in self.segments]
+        return merge_ranges(ranges)
+
+    def fail(self, segment):
+        """Put the unreceived rest of a failed segment back, give up after too many failures."""
+        with self.lock:
+            self.active.discard(segment)
+            if segment.done < segment.end:
+                self.pending.append((segment.done, segment.end))
+                segment.end = segment.done
+            self.failures += 1
+            if self.failures > MAX_FAILURES:
+                self.aborted = True
+
+def plan_stream_count(size, max_streams):
+    """Number of parallel streams worth opening for size bytes."""
+    # A stream is only worth it with MIN_SEGMENT_SIZE bytes, or MIN_SEGMENT_TIME seconds of work
+    per_stream = max(MIN_SEGMENT_SIZE, measured_stream_rate * MIN_SEGMENT_TIME)
+    return int(max(1, min(max_streams, size // per_stream)))
+
+def update_stream_rate(rate):
+    """Fold the per-stream throughput of a finished download into the running estimate."""
+    global measured_stream_rate
+    if rate <= 0:
+        return
+    if measured_stream_rate == 0:
+        measured_stream_rate = rate
+    else:
+        measured_stream_rate = 0.7 * measured_stream_rate + 0.3 * rate
+
+def download_segments(filename, scheduler, session, buffer, fd, pbar, rate, budget, verifier=None, codec=None):
+    """
+    Work through segments of the scheduler on one session until none are left.
+    DOWNLOAD requests are pipelined, PIPELINE_DEPTH in flight within the budget's in-flight
+    limit; data is received into buffer and written at its offset in fd (the preallocated
+    destination file), or into a temporary part file per segment when fd is None.
+    Written ranges are reported to verifier, if any. With codec, responses come as compressed
+    frames; the bandwidth limit counts the bytes received, not the decompressed ones.
+    Returns the measured throughput of the stream.
+    """
+    while True:
+        segment = scheduler.next_segment(rate)
+        if segment is None:
+            return rate
+        part_fd = None
+        base = 0
+        if fd is None:
+            # Create temporary part files
+            part_fd = os.open(f"{DOWNLOAD_DIR}/{filename}.part{segment.part}",
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+            base = segment.start
+        pending = deque()  # (offset, size, time sent) of requests sent but not yet answered
+        received = 0  # bytes of the response being received, not yet counted by the scheduler
+        try:
+            deferred = None  # request taken from the segment that didn't fit in the budget yet
+            last = time.monotonic()
             while True:
-                data = client.recv(1024)
-                if not data:
+                # Keep the pipeline full
+                while len(pending) < PIPELINE_DEPTH:
+                    request = deferred or scheduler.next_request(segment)
+                    deferred = None
+                    if request is None:
+                        break
+                    # Only wait for the budget with nothing in flight here: the responses
+                    # this session still has to read may be what frees it
+                    if not budget.reserve(request[1], block=not pending):
+                        deferred = request
+                        break
+                    session.send_request(f"DOWNLOAD {filename} {request[0]} {request[1]}"
+                                         + (f" codec={codec}" if codec else ""))
+                    pending.append((*request, time.monotonic()))
+                    metrics.inc("requests_total")
+                if not pending:
                     break
-                f.write(data)
-                pbar.update(len(data))  # Progressbar handling
-    client.close()
 
+                position, size, sent = pending[0]
+                length = session.recv_response_header()
+                received = 0
+                for data, wire in (recv_frames if codec else recv_raw)(session, buffer, length):
+                    n = len(data)
+                    write_at(part_fd if part_fd is not None else fd, data, position - base)
+                    if verifier:
+                        verifier.add(position, position + n)
+                    position += n
+                    received += n
+                    pbar.update(n)  # Progressbar handling
+                    budget.received(wire)
+                    metrics.inc("bytes_received_total", wire)
+                pending.popleft()
+                budget.release(size)
+                metrics.observe("request_seconds", time.monotonic() - sent)
 
-def merge_file(filename, total_parts):
+                # Responses arrive back to back, so the gap between two is one transfer time
+                now = time.monotonic()
+                sample = received / max(now - last, 1e-6)
+                rate = sample if rate <= 0 else 0.7 * rate + 0.3 * sample
+                last = now
+                scheduler.advance(segment, received, rate)
+                received = 0
+        except Exception:
+            # The part of a response received before the failure is requested again: drop it
+            # from the part file (merged whole) and from the progress bar
+            if part_fd is not None:
+                os.ftruncate(part_fd, segment.done - segment.start)
+            pbar.update(-received)
+            budget.release(sum(size for _, size, _ in pending))
+            scheduler.fail(segment)
+            raise
+        finally:
+            if part_fd is not None:
+                os.close(part_fd)
+        scheduler.finish(segment)
+
+def download_worker(filename, scheduler, server_host, server_port, fd, pbar, rates, budget, verifier=None, codec=None):
+    """One download stream: take segments until the file is done, reconnecting on errors."""
+    pool = get_session_pool(server_host, server_port)
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    rate = measured_stream_rate
+    with budget.connections:
+        while not scheduler.aborted:
+            try:
+                session = pool.acquire()
+            except OSError:
+                with scheduler.lock:
+                    scheduler.failures += 1
+                    scheduler.aborted = scheduler.failures > MAX_FAILURES
+                time.sleep(0.1)
+                continue
+            try:
+                rate = download_segments(filename, scheduler, session, buffer, fd, pbar, rate, budget, verifier, codec)
+            except (OSError, ProtocolError):
+                metrics.inc("stream_errors_total")
+                pool.release(session, reuse=False)
+                continue
+            pool.release(session)
+            break
+    rates.append(rate)
+
+def merge_file(filename, parts):
     """
-    Merge file from the temporary part files
+    Merge file from the temporary part files, parts being the part numbers in file order
     """
     with open(f"{DOWNLOAD_DIR}/{filename}", "wb") as f:
-        for part in range(1, total_parts + 1):
+        for part in parts:
             part_path = f"{DOWNLOAD_DIR}/{filename}.part{part}"
             with open(part_path, "rb") as part_file:
                 f.write(part_file.read())
             os.remove(part_path)  # deleted merged chunks
     print(f"File {filename} has been merged successfully.")
 
-def download_file(filename, file_size, server_host, server_port):
+def download_file(filename, file_size, server_host, server_port, write_mode="direct", max_streams=MAX_STREAMS,
+                  budget=None, verify=False, update=False, retries=0, codec=None):
     """
-    Split file into 4 chunks, with the last chunk holds the remaining bytes
-    For example : 
-    test.zip has 102 bytes
-    test.zip.part 1: 25 bytes
-    test.zip.part 2: 25 bytes
-    test.zip.part 3: 25 bytes
-    test.zip.part 4: 27 bytes
+    Download a file over up to max_streams parallel streams.
+    The number of streams and the segment length follow the file size and the measured
+    per-stream throughput (a 1 KB file uses a single stream); when a stream runs out of
+    work it steals the tail of the slowest remaining segment.
+    In "direct" mode the segments are written straight into a preallocated <filename>.partial
+    which is renamed once complete; "parts" mode writes part files and merges them
+    Direct downloads are resumable: the completed ranges are saved to <filename>.partial.json
+    every MANIFEST_INTERVAL seconds, and the next run only fetches what is missing unless
+    the server's STAT shows the file changed in between
+    Streams, requests and received bytes count against budget (the global limits shared
+    with other files downloading at the same time)
+    With verify (or update), direct downloads check every block against the server's block
+    manifest (BLOCKS) as it completes, and the blocks that fail are downloaded again, up to
+    MAX_BLOCK_RETRIES times. With update, an existing downloads/<filename> is reused: only its
+    blocks that differ from the server's version are downloaded
+    codec is the compression agreed with the server (fetch_codec), None for raw transfers
     """
-    chunk_size = file_size // 4
+    if budget is None:
+        budget = TransferBudget()
+    try:
+        file_size, mtime = fetch_file_stat(server_host, server_port, filename)
+    except ProtocolError as e:
+        print(f"[-] Failed to download {filename}: {e}")
+        return False
+
     threads = []
+    rates = []
+    fd = None
+    done = []
+    bad = []
+    verifier = None
+    partial_path = os.path.join(DOWNLOAD_DIR, f"{filename}.partial")
+    local_path = os.path.join(DOWNLOAD_DIR, filename)
+    manifest = None
+    if (verify or update) and write_mode == "direct":
+        manifest = fetch_block_manifest(server_host, server_port, filename)
+        if manifest is not None and (manifest.size, manifest.mtime) != (file_size, mtime):
+            manifest = None  # changed since STAT
+    if update and write_mode == "direct" and os.path.exists(local_path) and not os.path.exists(partial_path):
+        if manifest is None:
+            print(f"[!] No block manifest for {filename}, downloading all of it again")
+        else:
+            reused = reuse_local_copy(filename, manifest)
+            if reused is None:
+                print(f"[+] {filename} is up to date")
+                return True
+            print(f"[!] Updating {filename}: {reused} of {file_size} bytes unchanged")
+    if write_mode == "direct":
+        if os.path.exists(partial_path):
+            done = load_manifest(filename, file_size, mtime)
+        fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        if not done:
+            os.ftruncate(fd, 0)
+        preallocate(fd, file_size)
+        if manifest is not None:
+            verifier = BlockVerifier(partial_path, manifest, done)
+    scheduler = RangeScheduler(missing_ranges(done, file_size), max_streams, done, COMPRESS_BLOCK if codec else 1)
+    finished = threading.Event()
+    saver = None  # thread saving the progress of direct downloads
+    resumed = sum(end - start for start, end in done)
+    if resumed:
+        print(f"[!] Resuming {filename}: {resumed} of {file_size} bytes already downloaded")
 
-    for i in range(4):
-        offset = i * chunk_size
-        if i == 3:  # Last chunk takes the remaining bytes
-            chunk_size = file_size - offset
-        part = i + 1
-        # create thread to download chunk
-        t = threading.Thread(target=download_chunk, args=(filename, offset, chunk_size, part, 4, server_host, server_port))
-        threads.append(t)
-        t.start()
-
-    # Wait for all threads to finish downloading
-    for t in threads:
-        t.join()
-    
-    # Merge chunks into completed file
-    merge_file(filename, 4)
+    def save_progress():
+        while not finished.wait(MANIFEST_INTERVAL):
+            save_manifest(filename, file_size, mtime, scheduler.completed_ranges())
+
+    try:
+        with tqdm(total=file_size, initial=resumed, unit="B", unit_scale=True,
+                  desc=f"{filename} ({scheduler.streams} streams)", leave=True) as pbar:
+            if fd is not None:
+                saver = threading.Thread(target=save_progress, daemon=True)
+                saver.start()
+            for _ in range(scheduler.streams):
+                # create thread to download segments
+                t = threading.Thread(target=download_worker, daemon=True,
+                                     args=(filename, scheduler, server_host, server_port, fd, pbar, rates, budget,
+                                           verifier, codec))
+                threads.append(t)
+                t.start()
+
+            # Wait for all threads to finish downloading
+            for t in threads:
+                t.join()
+    finally:
+        finished.set()
+        if saver is not None:
+            saver.join()  # a save in progress would race with the final one (same .tmp file)
+        if fd is not None:
+            bad = verifier.finish() if verifier else []
+            os.close(fd)
+            # Also saved when interrupted, so the next run can resume (corrupt blocks excluded)
+            save_manifest(filename, file_size, mtime, remove_ranges(scheduler.completed_ranges(), bad, file_size))
+
+    if scheduler.aborted or any(s.done < s.end for s in scheduler.segments) or scheduler.pending:
+        print(f"[-] Failed to download {filename} after {scheduler.failures} errors")
+        return False
+
+    update_stream_rate(sum(rates) / len(rates) if rates else 0)
+    if bad:
+        metrics.inc("block_verify_failures_total", len(bad))
+        corrupt = sum(end - start for start, end in bad)
+        if retries >= MAX_BLOCK_RETRIES:
+            print(f"[-] {filename}: {corrupt} bytes still fail block verification after {retries} retries, giving up")
+            return False
+        print(f"[-] {filename}: {corrupt} bytes failed block verification, downloading them again")
+        return download_file(filename, file_size, server_host, server_port, write_mode, max_streams, budget, verify,
+                             update, retries + 1, codec)
+    if verifier:
+        print(f"[+] {filename} verified ({len(manifest.leaves)} blocks, SHA-256)")
+    if write_mode == "direct":
+        os.replace(partial_path, local_path)
+        remove_manifest(filename)
+    else:
+        # Merge chunks into completed file
+        parts = [s.part for s in sorted(scheduler.segments, key=lambda s: s.start)]
+        merge_file(filename, parts)
     print(f"[+] Downloaded {filename} successfully!")
+    return True
+
+class DownloadQueue:
+    """
+    Download several files at once: up to max_files run concurrently, started in priority
+    order ("smallest" file first, or "input" order), all sharing one TransferBudget.
+    """
+    def __init__(self, server_host, server_port, write_mode, max_streams, max_files, priority, budget, verify=False,
+                 update=False, codec=None):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.write_mode = write_mode
+        self.max_streams = max_streams
+        self.max_files = max_files
+        self.priority = priority
+        self.budget = budget
+        self.verify = verify
+        self.update = update
+        self.codec = codec
+
+    def run(self, files):
+        """Download the (filename, size) pairs in files, returns the filenames that completed."""
+        queue = list(files)
+        if self.priority == "smallest":
+            queue.sort(key=lambda item: item[1])
+        queue.reverse()  # pop() from the end
+        completed = []
+        lock = threading.Lock()
+        start_bytes = self.budget.bytes_received
+        start = time.monotonic()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    filename, size = queue.pop()
+                print(f"[!] Starting download for: {filename} ({size} bytes)")
+                started = time.monotonic()
+                metrics.add("active_downloads", 1)
+                try:
+                    ok = download_file(filename, size, self.server_host, self.server_port, self.write_mode,
+                                       self.max_streams, self.budget, self.verify, self.update, codec=self.codec)
+                except Exception as e:
+                    # Don't let one file take the worker, and the files queued behind it, down
+                    print(f"[-] Failed to download {filename}: {e}")
+                    ok = False
+                finally:
+                    metrics.add("active_downloads", -1)
+                if ok:
+                    metrics.inc("files_completed_total")
+                    metrics.observe("download_seconds", time.monotonic() - started)
+                    with lock:
+                        completed.append(filename)
+                else:
+                    metrics.inc("files_failed_total")
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(self.max_files, len(queue)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        received = self.budget.bytes_received - start_bytes
+        print(f"[+] {len(completed)}/{len(files)} file(s), {received / 1e6:.1f} MB in {elapsed:.2f}s "
+              f"({received / 1e6 / elapsed:.1f} MB/s aggregate)")
+        return completed
 
-def client_main(server_host, server_port):
+def client_main(server_host, server_port, write_mode, max_streams=MAX_STREAMS, max_files=MAX_FILES,
+                max_connections=MAX_CONNECTIONS, max_inflight=MAX_INFLIGHT, rate_limit=0, priority="smallest",
+                once=False, verify=False, update=False, compress=None, metrics_path=None):
     """
     Main client loop: only download wanted files in INPUT_FILE.
+    With once, the files wanted at startup are downloaded and the client returns.
+    With update, wanted files that were already downloaded are brought up to date with the
+    server (only the blocks that changed are downloaded).
+    compress is the codec to ask the server for, None for raw transfers.
+    With metrics_path, the client's metrics are written there after every batch of downloads.
     """
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     
     # get file list from the server (file_list.txt)
     server_files = fetch_file_list(server_host, server_port)
+    codec = fetch_codec(server_host, server_port, compress) if compress else None
+    if compress:
+        print(f"[!] Compression: {codec or 'none (not supported by the server)'}")
     files_displayed = False
+    budget = TransferBudget(max_connections, max_inflight, rate_limit)
+    download_queue = DownloadQueue(server_host, server_port, write_mode, max_streams, max_files, priority, budget,
+                                   verify, update, codec)
     
     while True:
         # get filenames from INPUT_FILE (input.txt)
@@ -181,12 +984,16 @@ def client_main(server_host, server_port):
             display_available_files(server_files)
             files_displayed = True
         
-        for filename in input_files:
-            # Only download available and not yet downloaded file
-            if filename in server_files and filename not in downloaded_files and not os.path.exists(os.path.join(DOWNLOAD_DIR, filename)):
-                print(f"[!] Starting download for: {filename} ({server_files[filename]} bytes)")
-                download_file(filename, server_files[filename], server_host, server_port)
-                downloaded_files.add(filename)
+        # Only download available and not yet downloaded file
+        wanted = [(filename, server_files[filename]) for filename in dict.fromkeys(input_files)
+                  if filename in server_files and filename not in downloaded_files
+                  and (update or not os.path.exists(os.path.join(DOWNLOAD_DIR, filename)))]
+        if wanted:
+            downloaded_files.update(download_queue.run(wanted))
+            if metrics_path:
+                save_metrics(metrics_path)
+        if once:
+            return
 
         # Wait 5s after checking INPUT_FILE for additional file(s)
         time.sleep(5)
@@ -195,10 +1002,34 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="TCP Client")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Server IP address")
     parser.add_argument("--port", type=int, default=8000, help="Server port")
+    parser.add_argument("--write-mode", choices=WRITE_MODES, default="direct",
+                        help="direct: write ranges into a preallocated file, parts: part files merged at the end")
+    parser.add_argument("--streams", type=int, default=MAX_STREAMS, help="Maximum parallel streams per file")
+    parser.add_argument("--max-files", type=int, default=MAX_FILES, help="Files downloaded at the same time")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Streams open at the same time, over all files")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT,
+                        help="Bytes requested but not yet received, over all files")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Total download bandwidth in bytes/s (0 = unlimited)")
+    parser.add_argument("--priority", choices=PRIORITIES, default="smallest",
+                        help="Order in which queued files are started")
+    parser.add_argument("--once", action="store_true", help="Download the files in input.txt, then exit")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check every block of the downloads against the server's SHA-256s")
+    parser.add_argument("--update", action="store_true",
+                        help="Bring files already downloaded up to date, fetching only changed blocks")
+    parser.add_argument("--compress", choices=tuple(CODECS),
+                        help="Ask the server to compress the transfers with this codec")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write the client's metrics to FILE after each batch (.prom: Prometheus text, else JSON)")
     args = parser.parse_args()
+    if (args.verify or args.update) and args.write_mode != "direct":
+        parser.error("--verify and --update need --write-mode direct")
     print(socket_art)
     try:
-        client_main(args.host, args.port)
+        client_main(args.host, args.port, args.write_mode, args.streams, args.max_files,
+                    args.max_connections, args.max_inflight, args.rate_limit, args.priority, args.once,
+                    args.verify, args.update, args.compress, args.metrics)
     except KeyboardInterrupt:
         os.remove("file_list.txt") # delete file_list.txt of client
         print("\nClient exited.")
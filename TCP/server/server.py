@@ -1,70 +1,575 @@
 import argparse
+import asyncio
+import bz2
+import lzma
 import socket
+import struct
+import sys
 import threading
 import os
+import time
+import zlib
+from collections import namedtuple
+
+try:
+    import resource  # Unix only, used to raise the open file limit
+except ImportError:
+    resource = None
+
+# The code shared by the servers and the clients lives in common/, at the top of the project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.compression import CompressionCache
+from common.files import FILE_CACHE_SIZE, FileCache, FileIndex
+from common.metrics import METRICS_FORMATS, Metrics
+from common.pacing import SCHEDULER_QUANTUM, FairScheduler
 
 FILE_DIR = "server_files"
-FILE_LIST = "file_list.txt"
+INDEX_INTERVAL = 1.0  # Seconds between two refreshes of the file index
 
-def handle_client(client_socket):
-    try:
-        request = client_socket.recv(1024).decode()
-        command, *args = request.split()
-
-        if command == "LIST":
-            # Send file_list.txt to client
-            with open(FILE_LIST, "rb") as f:
-                client_socket.sendall(f.read())
-
-        elif command == "DOWNLOAD":
-            filename, offset, chunk_size = args
-            offset = int(offset)
-            chunk_size = int(chunk_size)
-            filepath = os.path.join(FILE_DIR, filename)
-
-            if os.path.exists(filepath):
-                with open(filepath, "rb") as f:
-                    f.seek(offset)
-                    data = f.read(chunk_size)
-                    client_socket.sendall(data)
+# Framed protocol: every request is <length:u32><command text>, every response is
+# <status:u8><length:u64><body>. A connection carries any number of requests and
+# the client may pipeline them; responses are always sent back in request order.
+REQUEST_HEADER = struct.Struct("!I")
+RESPONSE_HEADER = struct.Struct("!BQ")
+STATUS_OK = 0
+STATUS_ERROR = 1
+MAX_REQUEST_SIZE = 64 * 1024
+SEND_BLOCK_SIZE = 256 * 1024  # Buffer size of the copy data path, per connection
+SEND_MODES = ("sendfile", "copy")
+ENGINES = ("threads", "asyncio")
+WRITE_BUFFER_HIGH = 1024 * 1024  # asyncio engine: pause a connection's writer above this many queued bytes
+COMPRESS_BLOCK = 256 * 1024  # Compressed DOWNLOAD responses are cut in frames at these file offsets
+# Commands counted by name in the metrics (anything else is "other")
+COMMANDS = ("LIST", "DOWNLOAD", "STAT", "BLOCKS", "COMPRESS", "CACHE", "STATS")
+
+# A DOWNLOAD response body: count bytes of the CachedFile file starting at offset
+FileRange = namedtuple("FileRange", ["file", "offset", "count"])
+# Frame of a compressed DOWNLOAD response: codec id (0 = raw), raw length, payload length
+FRAME_HEADER = struct.Struct("!BII")
+Codec = namedtuple("Codec", ["id", "compress"])
+# Compression codecs, by name: id on the wire (0 = raw) and compress function
+CODECS = {
+    "zlib": Codec(1, lambda data: zlib.compress(data, 6)),
+    "bz2": Codec(2, lambda data: bz2.compress(data, 9)),
+    "lzma": Codec(3, lambda data: lzma.compress(data, preset=1)),
+}
+
+class CachedFile:
+    """An open file shared by the transfers reading it; size and mtime are those of the open file."""
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        st = os.fstat(self.f.fileno())
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.refs = 0         # transfers using the file
+        self.cached = False   # still in the cache (closed by the last release() otherwise)
+
+    def close(self):
+        self.f.close()
+
+def parse_options(args):
+    """Parse key=value request arguments into a dict."""
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        options[key] = value
+    return options
+
+# Catalog of FILE_DIR, kept up to date by a background thread
+file_index = FileIndex(FILE_DIR)
+# Open files of FILE_DIR shared by the transfers, invalidated by the index watcher
+file_cache = FileCache(FILE_DIR, CachedFile)
+# Compressed blocks shared by the transfers
+compression_cache = CompressionCache()
+# Counters and latency histograms served by STATS
+metrics = Metrics("tcp_server_")
+# Fair-share pacing of the file data (--rate-limit, --client-rate, --weight)
+scheduler = FairScheduler(metrics=metrics)
+verbosity = 0  # -v: also log every accepted connection
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes, or return None if the peer closed the connection first."""
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = sock.recv(size - len(buffer))
+        if not data:
+            return None
+        buffer += data
+    return bytes(buffer)
+
+def recv_request(client_socket):
+    """Read one framed request, returns None once the client has closed the session."""
+    header = recv_exact(client_socket, REQUEST_HEADER.size)
+    if header is None:
+        return None
+    (length,) = REQUEST_HEADER.unpack(header)
+    if length > MAX_REQUEST_SIZE:
+        raise ValueError(f"request too large ({length} bytes)")
+    payload = recv_exact(client_socket, length)
+    if payload is None:
+        return None
+    return payload.decode()
+
+def send_response(client_socket, status, body=b""):
+    """Send one framed response."""
+    client_socket.sendall(RESPONSE_HEADER.pack(status, len(body)) + body)
+
+def read_block(f, offset, size):
+    """Read up to size bytes at offset without moving the position of f (shared by transfers)."""
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), size, offset)
+    with file_cache.lock:  # no pread (Windows): seek + read must not interleave
+        f.seek(offset)
+        return f.read(size)
+
+def send_file_range(client_socket, file, offset, count, send_mode, buffer, share=None):
+    """
+    Stream count bytes of the CachedFile file starting at offset to the client.
+    "sendfile" lets the kernel copy straight from the page cache; "copy" (and platforms
+    without os.sendfile) goes through the fixed per-connection buffer, so memory use
+    never depends on the range size.
+    With share (the client's ClientShare), every SCHEDULER_QUANTUM bytes wait for the scheduler.
+    """
+    if count == 0:
+        return
+    step = SCHEDULER_QUANTUM if share is not None else count
+    if send_mode == "sendfile" and hasattr(os, "sendfile"):
+        sent = 0
+        while sent < count:
+            n = min(step, count - sent)
+            if share is not None:
+                scheduler.acquire(share, n)
+            done = client_socket.sendfile(file.f, offset + sent, n)
+            sent += done
+            if done < n:
+                break
+    else:
+        sent = 0
+        fd = file.f.fileno()
+        while sent < count:
+            size = min(len(buffer), step, count - sent)
+            if hasattr(os, "preadv"):
+                n = os.preadv(fd, [buffer[:size]], offset + sent)
             else:
-                client_socket.sendall(b"ERROR: File not found")
+                data = read_block(file.f, offset + sent, size)
+                n = len(data)
+                buffer[:n] = data
+            if not n:
+                break
+            if share is not None:
+                scheduler.acquire(share, n)
+            client_socket.sendall(buffer[:n])
+            sent += n
+
+    if sent != count:
+        # The length was already announced, the session can't be resynchronised
+        raise ConnectionError(f"file shrank while sending ({sent}/{count} bytes)")
+
+def send_paced(client_socket, body, share):
+    """Send a DOWNLOAD body held in memory (compressed frames), granted by the scheduler piece by piece."""
+    view = memoryview(body)
+    for start in range(0, len(view), SCHEDULER_QUANTUM):
+        piece = view[start:start + SCHEDULER_QUANTUM]
+        scheduler.acquire(share, len(piece))
+        client_socket.sendall(piece)
+
+def compress_range(name, file, offset, count, codec):
+    """
+    Body of a compressed DOWNLOAD response: the range cut at COMPRESS_BLOCK boundaries of the
+    file (so every client asks the compression cache for the same blocks), each piece sent as
+    a FRAME_HEADER + payload, raw (codec id 0) when it doesn't compress.
+    """
+    frames = []
+    end = offset + count
+    while offset < end:
+        piece_end = min(end, (offset // COMPRESS_BLOCK + 1) * COMPRESS_BLOCK)
+        data = read_block(file.f, offset, piece_end - offset)
+        if len(data) != piece_end - offset:
+            raise ConnectionError(f"file shrank while compressing ({offset + len(data)}/{end} bytes)")
+        compressed = compression_cache.get((name, file.mtime, offset, len(data), codec), data, CODECS[codec])
+        if compressed is None:
+            frames += [FRAME_HEADER.pack(0, len(data), len(data)), data]
+        else:
+            frames += [FRAME_HEADER.pack(CODECS[codec].id, len(data), len(compressed)), compressed]
+        offset = piece_end
+    return b"".join(frames)
+
+def render_metrics(fmt):
+    """STATS body: the metrics, plus the counters of the file and compression caches."""
+    stats = {**file_cache.stats(), **compression_cache.stats()}
+    gauges = {"file_cache_files": stats.pop("files"), "file_cache_bytes": stats.pop("bytes"),
+              "scheduled_clients": len(scheduler.clients)}
+    counters = {(key if key.startswith("compress_") else f"file_cache_{key}") + "_total": value
+                for key, value in stats.items()}
+    return metrics.render(fmt, counters, gauges)
+
+def record_request(request, status, sent, start):
+    """Account for a request answered with sent bytes, start being when it was received."""
+    command = request.split(None, 1)[0] if request.strip() else ""
+    command = command if command in COMMANDS else "other"
+    metrics.inc(f'requests_total{{command="{command}"}}')
+    metrics.observe(f'request_seconds{{command="{command}"}}', time.monotonic() - start)
+    metrics.inc("bytes_sent_total", sent)
+    if status != STATUS_OK:
+        metrics.inc("errors_total")
+
+def process_request(request):
+    """
+    Resolve one request to (status, body), body being bytes or a FileRange to stream.
+    Shared by every engine; raises ValueError/IndexError on malformed requests.
+    """
+    command, *args = request.split() or [""]
+
+    if command == "LIST":
+        # LIST [prefix=<prefix>] [offset=<n>] [limit=<n>], served from the file index
+        options = parse_options(args)
+        offset = int(options.get("offset", 0))
+        limit = int(options["limit"]) if "limit" in options else None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("negative offset or limit")
+        return STATUS_OK, file_index.list_files(options.get("prefix", ""), offset, limit)
+
+    elif command == "DOWNLOAD":
+        # DOWNLOAD <filename> <offset> <size> [codec=<name>], codec as agreed with COMPRESS
+        filename, offset, chunk_size, *options = args
+        offset = int(offset)
+        chunk_size = int(chunk_size)
+        codec = parse_options(options).get("codec")
+
+        if offset < 0 or chunk_size < 0:
+            raise ValueError("negative offset or size")
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f"unknown codec {codec!r}")
+
+        try:
+            file = file_cache.acquire(filename, file_index.lookup(filename))
+        except OSError:
+            return STATUS_ERROR, b"ERROR: File not found"
+        count = max(0, min(chunk_size, file.size - offset))
+        if codec is None:
+            return STATUS_OK, FileRange(file, offset, count)
+        try:
+            return STATUS_OK, compress_range(filename, file, offset, count, codec)
+        finally:
+            file_cache.release(file)
+
+    elif command == "COMPRESS":
+        # COMPRESS <codec>,<codec>,...: the first of the client's codecs this server has, or "none"
+        offered = args[0].split(",") if args else []
+        return STATUS_OK, next((codec for codec in offered if codec in CODECS), "none").encode()
+
+    elif command == "STAT":
+        # Size and modification time, lets clients tell whether a partial download is still valid
+        (filename,) = args
+        filepath = os.path.join(FILE_DIR, filename)
+        if not os.path.isfile(filepath):
+            return STATUS_ERROR, b"ERROR: File not found"
+        st = os.stat(filepath)
+        return STATUS_OK, f"{st.st_size} {st.st_mtime_ns}".encode()
+
+    elif command == "BLOCKS":
+        # Block manifest: "<size> <mtime> <block size> <blocks> <merkle root>\n" then one block
+        # SHA-256 per line, for per-block verification and delta updates of local copies
+        (filename,) = args
+        try:
+            manifest = file_index.block_manifest(filename)
+        except OSError:
+            manifest = None
+        if manifest is None:
+            return STATUS_ERROR, b"ERROR: File not found"
+        header = (f"{manifest.size} {manifest.mtime} {manifest.block_size} {len(manifest.leaves)} "
+                  f"{manifest.root.hex()}\n")
+        return STATUS_OK, (header + "\n".join(leaf.hex() for leaf in manifest.leaves)).encode()
+
+    elif command == "STATS":
+        # STATS [format=json|prometheus]: counters, gauges and latency histograms of the server
+        fmt = parse_options(args).get("format", "json")
+        if fmt not in METRICS_FORMATS:
+            raise ValueError(f"unknown format {fmt!r}")
+        return STATUS_OK, render_metrics(fmt).encode()
+
+    elif command == "CACHE":
+        # Counters of the file cache and the compression cache
+        stats = {**file_cache.stats(), **compression_cache.stats()}
+        return STATUS_OK, " ".join(f"{key}={value}" for key, value in stats.items()).encode()
+
+    return STATUS_ERROR, f"ERROR: Unknown command {command!r}".encode()
+
+def handle_request(client_socket, request, send_mode, buffer, share=None):
+    """
+    Serve a single framed request on an open session (threads engine).
+    With share, the file data of DOWNLOAD responses is paced by the scheduler; the other
+    responses, and the headers, are not.
+    """
+    start = time.monotonic()
+    try:
+        status, body = process_request(request)
+    except (ValueError, IndexError) as e:
+        # Malformed request: report it but keep the session usable
+        status, body = STATUS_ERROR, f"ERROR: Bad request ({e})".encode()
+
+    if isinstance(body, FileRange):
+        try:
+            client_socket.sendall(RESPONSE_HEADER.pack(status, body.count))
+            send_file_range(client_socket, body.file, body.offset, body.count, send_mode, buffer, share)
+        finally:
+            file_cache.release(body.file)
+        record_request(request, status, RESPONSE_HEADER.size + body.count, start)
+    elif share is not None and status == STATUS_OK and request.startswith("DOWNLOAD "):
+        client_socket.sendall(RESPONSE_HEADER.pack(status, len(body)))
+        send_paced(client_socket, body, share)
+        record_request(request, status, RESPONSE_HEADER.size + len(body), start)
+    else:
+        send_response(client_socket, status, body)
+        record_request(request, status, RESPONSE_HEADER.size + len(body), start)
+
+def handle_client(client_socket, send_mode):
+    """Serve framed requests until the client closes its session."""
+    buffer = memoryview(bytearray(SEND_BLOCK_SIZE)) if send_mode == "copy" or not hasattr(os, "sendfile") else None
+    metrics.inc("connections_total")
+    metrics.add("active_connections", 1)
+    share = None
+    try:
+        if scheduler.enabled:
+            share = scheduler.open(client_socket.getpeername()[0])
+        while True:
+            request = recv_request(client_socket)
+            if request is None:
+                break
+            handle_request(client_socket, request, send_mode, buffer, share)
     except Exception as e:
+        metrics.inc("connection_errors_total")
         print(f"Error handling client: {e}")
     finally:
+        if share is not None:
+            scheduler.close(share)
+        metrics.add("active_connections", -1)
         client_socket.close()
-        
 
-def update_file_list():
-    # Update file_list.txt with file and file's size
-    with open(FILE_LIST, "w") as f:
-        for filename in os.listdir(FILE_DIR):
-            filepath = os.path.join(FILE_DIR, filename)
-            if os.path.isfile(filepath):
-                size = os.path.getsize(filepath)
-                f.write(f"{filename} {size}\n")
+async def async_send_file_range(writer, file, offset, count, send_mode, share=None):
+    """asyncio version of send_file_range; every write waits for the socket to drain."""
+    if count == 0:
+        return
+    loop = asyncio.get_running_loop()
+    await writer.drain()  # flush the header first
+    step = SCHEDULER_QUANTUM if share is not None else count
+    if send_mode == "sendfile" and hasattr(os, "sendfile"):
+        # The transport's fallback would seek the shared file, hence the os.sendfile check
+        sent = 0
+        while sent < count:
+            n = min(step, count - sent)
+            if share is not None:
+                await scheduler.acquire_async(share, n)
+            done = await loop.sendfile(writer.transport, file.f, offset + sent, n)
+            sent += done
+            if done < n:
+                break
+    else:
+        sent = 0
+        while sent < count:
+            # pread blocks on a cold page cache, off the event loop like the file opens
+            size = min(SEND_BLOCK_SIZE, step, count - sent)
+            data = await loop.run_in_executor(None, read_block, file.f, offset + sent, size)
+            if not data:
+                break
+            if share is not None:
+                await scheduler.acquire_async(share, len(data))
+            writer.write(data)
+            await writer.drain()
+            sent += len(data)
+
+    if sent != count:
+        raise ConnectionError(f"file shrank while sending ({sent}/{count} bytes)")
 
-def server_main(server_host, server_port):
-    update_file_list()
+async def async_handle_client(client_socket, send_mode):
+    """Serve framed requests on one connection (asyncio engine)."""
+    reader, writer = await asyncio.open_connection(sock=client_socket)
+    writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+    metrics.inc("connections_total")
+    metrics.add("active_connections", 1)
+    share = scheduler.open(client_socket.getpeername()[0]) if scheduler.enabled else None
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(REQUEST_HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+            (length,) = REQUEST_HEADER.unpack(header)
+            if length > MAX_REQUEST_SIZE:
+                raise ValueError(f"request too large ({length} bytes)")
+            request = (await reader.readexactly(length)).decode()
+            start = time.monotonic()
+
+            try:
+                if request.partition(" ")[0] in ("LIST", "COMPRESS", "CACHE", "STATS"):
+                    status, body = process_request(request)  # answered from memory
+                else:
+                    # DOWNLOAD opens the file (on a file cache miss) and STAT stats it, the first
+                    # BLOCKS of a file hashes all of it and compressed DOWNLOADs compress: keep
+                    # that off the event loop
+                    status, body = await asyncio.get_running_loop().run_in_executor(None, process_request, request)
+            except (ValueError, IndexError) as e:
+                status, body = STATUS_ERROR, f"ERROR: Bad request ({e})".encode()
+
+            if isinstance(body, FileRange):
+                try:
+                    writer.write(RESPONSE_HEADER.pack(status, body.count))
+                    await async_send_file_range(writer, body.file, body.offset, body.count, send_mode, share)
+                finally:
+                    file_cache.release(body.file)
+                record_request(request, status, RESPONSE_HEADER.size + body.count, start)
+            elif share is not None and status == STATUS_OK and request.startswith("DOWNLOAD "):
+                writer.write(RESPONSE_HEADER.pack(status, len(body)))
+                view = memoryview(body)
+                for piece_start in range(0, len(view), SCHEDULER_QUANTUM):
+                    piece = view[piece_start:piece_start + SCHEDULER_QUANTUM]
+                    await scheduler.acquire_async(share, len(piece))
+                    writer.write(piece)
+                    await writer.drain()
+                record_request(request, status, RESPONSE_HEADER.size + len(body), start)
+            else:
+                writer.write(RESPONSE_HEADER.pack(status, len(body)) + body)
+                await writer.drain()
+                record_request(request, status, RESPONSE_HEADER.size + len(body), start)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        metrics.inc("connection_errors_total")  # client went away mid-request
+    except Exception as e:
+        metrics.inc("connection_errors_total")
+        print(f"Error handling client: {e}")
+    finally:
+        if share is not None:
+            scheduler.close(share)
+        metrics.add("active_connections", -1)
+        writer.close()
+
+async def async_server_main(server, send_mode, max_connections):
+    """Accept loop of the asyncio engine, at most max_connections sessions at a time."""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_connections)
+    tasks = set()
+
+    async def serve(client_socket):
+        try:
+            await async_handle_client(client_socket, send_mode)
+        finally:
+            slots.release()
+
+    while True:
+        # Stop accepting while full, new clients wait in the kernel backlog
+        await slots.acquire()
+        client_socket, addr = await loop.sock_accept(server)
+        if verbosity:
+            print(f"Accepted connection from {addr}")
+        task = asyncio.create_task(serve(client_socket))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+def raise_file_limit(max_connections):
+    """Make sure the process may keep max_connections sockets (plus open files) open."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * max_connections + file_cache.max_files + 64  # one socket and one file per transfer, cached files
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        if new_soft < wanted:
+            print(f"[!] Open file limit is {new_soft}, fewer than {max_connections} transfers may fit")
+
+def server_main(server_host, server_port, send_mode, engine="threads", backlog=128, max_connections=1024,
+                compute_hashes=False, cache_size=FILE_CACHE_SIZE, verbose=0, rate_limit=0, client_rate=0, weights=None):
+    """
+    Serve server_files/ on server_host:server_port. rate_limit and client_rate cap the file
+    data sent in total and to each client address (bytes/s, 0 = unlimited) and the scheduler
+    shares the bandwidth among the clients in proportion to weights (address -> weight, default 1).
+    """
+    global verbosity
+    verbosity = verbose
+    scheduler.configure(rate_limit, client_rate, weights)
+    file_index.compute_hashes = compute_hashes
+    file_index.refresh()
+    file_cache.max_bytes = cache_size
+    threading.Thread(target=file_index.watch, args=(INDEX_INTERVAL, file_cache.invalidate), daemon=True).start()
+    raise_file_limit(max_connections)
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((server_host, server_port))
-    server.listen(5)
-    print(f"Server listening on {server_host}:{server_port}...")
+    server.listen(backlog)
+    print(f"Server listening on {server_host}:{server_port} (engine: {engine}, send mode: {send_mode})...")
+    if scheduler.enabled:
+        print(f"[!] Fair-share scheduling: {rate_limit or 'unlimited'} B/s in total, "
+              f"{client_rate or 'unlimited'} B/s per client")
+
+    if engine == "asyncio":
+        server.setblocking(False)
+        asyncio.run(async_server_main(server, send_mode, max_connections))
+        return
+
+    slots = threading.BoundedSemaphore(max_connections)
+
+    def serve(client_socket):
+        try:
+            handle_client(client_socket, send_mode)
+        finally:
+            slots.release()
 
     while True:
+        # Stop accepting while full, new clients wait in the kernel backlog
+        slots.acquire()
         client_socket, addr = server.accept()
-        print(f"Accepted connection from {addr}")
-        client_thread = threading.Thread(target=handle_client, args=(client_socket,))
+        if verbosity:
+            print(f"Accepted connection from {addr}")
+        client_thread = threading.Thread(target=serve, args=(client_socket,), daemon=True)
         client_thread.start()
 
+def validate_rate(value):
+    """Validate a bandwidth cap in bytes/s: 0 (unlimited) or a positive integer."""
+    try:
+        int_value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid rate: {value}")
+    if int_value < 0:
+        raise argparse.ArgumentTypeError(f"Rate must be 0 (unlimited) or positive, got {int_value}")
+    return int_value
+
+def validate_weight(value):
+    """Validate a scheduler weight given as ADDRESS=WEIGHT, returns (address, weight)."""
+    address, _, weight = value.partition("=")
+    try:
+        float_weight = float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid weight, expected ADDRESS=WEIGHT: {value}")
+    if not address or float_weight <= 0:
+        raise argparse.ArgumentTypeError(f"Weight must be ADDRESS=WEIGHT with WEIGHT > 0, got {value}")
+    return address, float_weight
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="TCP Server")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Server IP address")
     parser.add_argument("--port", type=int, default=8000, help="Server port")
+    parser.add_argument("--send-mode", choices=SEND_MODES, default="sendfile",
+                        help="DOWNLOAD data path: zero-copy sendfile or a bounded read/send loop")
+    parser.add_argument("--engine", choices=ENGINES, default="threads",
+                        help="threads: one thread per connection, asyncio: single event loop")
+    parser.add_argument("--backlog", type=int, default=128, help="Listen backlog for pending connections")
+    parser.add_argument("--max-connections", type=int, default=1024,
+                        help="Maximum number of sessions served at the same time")
+    parser.add_argument("--hash", action="store_true", help="Keep a SHA-256 of every file in the index")
+    parser.add_argument("--cache-size", type=int, default=FILE_CACHE_SIZE,
+                        help="Total size (bytes) of the files kept open for reuse, 0 disables the file cache")
+    parser.add_argument("--rate-limit", type=validate_rate, default=0,
+                        help="Total bandwidth of the file data in bytes/s (0 = unlimited)")
+    parser.add_argument("--client-rate", type=validate_rate, default=0,
+                        help="Bandwidth cap of each client address in bytes/s (0 = unlimited)")
+    parser.add_argument("--weight", type=validate_weight, action="append", default=[], metavar="ADDRESS=WEIGHT",
+                        help="Share of the bandwidth of a client address relative to the others (default 1), "
+                             "repeatable")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Also log every accepted connection")
     args = parser.parse_args()
     try:
         os.makedirs(FILE_DIR, exist_ok=True)
-        server_main(args.host, args.port)
+        server_main(args.host, args.port, args.send_mode, args.engine, args.backlog, args.max_connections, args.hash,
+                    args.cache_size, args.verbose, args.rate_limit, args.client_rate, dict(args.weight))
     except KeyboardInterrupt:
         print("\nServer exited.")
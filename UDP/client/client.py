@@ -1,15 +1,68 @@
 import argparse
+import bisect
+import bz2
+import json
+import lzma
 import socket
 import os
 import hashlib
+import random
+import struct
+import sys
 import threading
 import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# The code shared by the servers and the clients lives in common/, at the top of the project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.files import merkle_root
+from common.metrics import Metrics
+from common.pacing import TokenBucket
 
 
 # Server configuration
 DOWNLOAD_DIR = "downloads"
 INPUT_FILE = "input.txt"
 FILE_LIST = "file_list.txt"
+LIST_CACHE = "file_list.cache"  # etag + listing kept between runs
+LIST_WINDOW = 8           # LIST page requests in flight
+LIST_TIMEOUT = 0.5        # Seconds before a LIST page request is sent again
+LIST_RETRIES = 10         # Times a single page is requested before giving up
+REQUEST_TIMEOUT = 2       # Seconds to wait for the reply of a control request
+REQUEST_RETRIES = 3
+MANIFEST_INTERVAL = 1.0   # Seconds between two saves of a download manifest
+MAX_REQUEST_RANGES = 48   # Byte ranges per DOWNLOAD request, so it fits in one datagram
+MAX_FILES = 4             # Files downloaded at the same time
+SESSION_TIMEOUT = 30      # Seconds without any packet before a download is given up
+MAX_INFLIGHT = 256 * 1024 * 1024  # Bytes admitted but not yet received, over all files
+PRIORITIES = ("smallest", "input")
+RECV_BUFFER_SIZE = 4 * 1024 * 1024  # Socket receive buffer, absorbs the server's congestion window
+RECV_SIZE = 65535         # Largest datagram, size of the reusable receive buffer
+HASH_TIMEOUT = 60         # Seconds to wait for HASH, the server may have to read the whole file first
+PROTOCOL_VERSION = 1      # First byte of binary datagrams (text replies start with a letter)
+PACKET_DATA = 1           # Packet type of a file chunk
+PACKET_ACK = 2            # Packet type of an acknowledgement
+PACKET_PARITY = 3         # Packet type of the XOR parity of a group of chunks (flags = chunks in the group)
+# version, type, flags, session, sequence number, file offset, payload length, CRC-32
+DATA_HEADER = struct.Struct("!BBHIIQII")
+# version, type, number of SACK ranges, session, cumulative ACK (every lower sequence number received)
+ACK_HEADER = struct.Struct("!BBHII")
+SACK_RANGE = struct.Struct("!II")  # first and end (exclusive) sequence numbers received above the cumulative ACK
+MAX_SACK_RANGES = 128     # SACK ranges per ACK datagram (lowest first)
+ACK_EVERY = 16            # Chunks received before an ACK is sent
+ACK_DELAY = 0.005         # Longest time an ACK is held back, in seconds
+# UDP payloads probed for the chunk size: IPv6 minimum MTU, Ethernet, jumbo frames, loopback
+PROBE_SIZES = (1232, 1472, 8972, 16356, 32740, 65507)
+PROBE_TIMEOUT = 0.5       # Seconds to wait for the PROBE replies
+DATAGRAM_SIZE = 0         # Largest datagram the PROBE saw arrive whole (0: not probed), sent with DOWNLOAD
+VERIFY_THREADS = 4        # Blocks hashed in parallel by --verify and --update
+MAX_BLOCK_RETRIES = 2     # Times the blocks that fail verification are downloaded again
+Codec = namedtuple("Codec", ["id", "decompress"])
+# Compression codecs the client can ask for, by name (see COMPRESS), and by id (DATA flags)
+CODECS = {"zlib": Codec(1, zlib.decompress), "bz2": Codec(2, bz2.decompress), "lzma": Codec(3, lzma.decompress)}
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
 socket_art = """
     ██╗   ██╗██████╗ ██████╗     
     ██║   ██║██╔══██╗██╔══██╗    
@@ -28,30 +81,275 @@ socket_art = """
 # A set to avoid re-downloading files
 downloaded_files = set()
 
-def calculate_checksum(data):
-    """Calculate and return the MD5 checksum of the given data."""
-    return hashlib.md5(data).hexdigest()
+# Counters and latency histograms of the downloads, written by --metrics
+metrics = Metrics("udp_client_")
+verbosity = 0  # -v: also log every corrupted or unexpected chunk
+
+def save_metrics(path):
+    """Write the metrics to path: Prometheus text for a .prom file, JSON otherwise."""
+    with open(path, "w") as f:
+        f.write(metrics.render("prometheus" if path.endswith(".prom") else "json"))
+
+class TransferBudget:
+    """
+    Global limits shared by every running download: bytes in flight and bandwidth.
+    A transfer reserves the bytes it still has to receive before it starts and gives them
+    back chunk by chunk; the bandwidth limit holds back ACKs, which stalls the server's window.
+    """
+    def __init__(self, max_inflight=MAX_INFLIGHT, rate=0):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.bytes_received = 0
+        self.cond = threading.Condition()
+        self.bucket = TokenBucket(rate)
+
+    def reserve(self, n):
+        with self.cond:
+            # A single file larger than the budget still goes through on its own
+            while self.inflight and self.inflight + n > self.max_inflight:
+                self.cond.wait()
+            self.inflight += n
+
+    def release(self, n):
+        with self.cond:
+            self.inflight -= n
+            self.cond.notify_all()
+
+    def received(self, n):
+        """Count n received bytes, sleeping if that goes over the bandwidth limit."""
+        with self.cond:
+            self.bytes_received += n
+        self.bucket.consume(n)
+
+def parse_data_packet(packet):
+    """
+    Parse and verify a chunk or parity datagram in place: (type, flags, session, seq, offset,
+    payload memoryview), or None when it is neither or its CRC-32 doesn't match.
+    """
+    if len(packet) < DATA_HEADER.size or packet[0] != PROTOCOL_VERSION:
+        return None
+    _, packet_type, flags, session_id, seq, offset, length, crc = DATA_HEADER.unpack_from(packet)
+    view = memoryview(packet)
+    payload = view[DATA_HEADER.size:]
+    if packet_type not in (PACKET_DATA, PACKET_PARITY) or len(payload) != length:
+        return None
+    if zlib.crc32(payload, zlib.crc32(view[:DATA_HEADER.size - 4])) != crc:
+        return None
+    return packet_type, flags, session_id, seq, offset, payload
+
+class AckState:
+    """
+    Sequence numbers received in a transfer, kept as a cumulative ACK point plus sorted SACK
+    ranges above it, and the delayed-ACK policy: an ACK goes out every ACK_EVERY chunks or
+    ACK_DELAY after the first unacknowledged one, and right away when a chunk opens or fills
+    a gap (the server then learns about the loss, or its repair, without delay).
+    """
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.cumulative = 0
+        self.ranges = []       # [start, end) lists, disjoint, above cumulative
+        self.highest = -1
+        self.pending = 0       # chunks received since the last ACK
+        self.pending_since = None
 
-def fetch_chunk_size(server_host, server_port):
-    """Send a request to the server for the chunk size for a given filename."""
+    def add(self, seq):
+        """Record a newly received chunk, True when the ACK should be sent now."""
+        urgent = seq != self.highest + 1
+        self.highest = max(self.highest, seq)
+        if seq == self.cumulative:
+            self.cumulative += 1
+            if self.ranges and self.ranges[0][0] == self.cumulative:
+                self.cumulative = self.ranges.pop(0)[1]
+        else:
+            i = bisect.bisect_right(self.ranges, [seq])
+            if i and self.ranges[i - 1][1] == seq:
+                self.ranges[i - 1][1] += 1
+                i -= 1
+            else:
+                self.ranges.insert(i, [seq, seq + 1])
+            if i + 1 < len(self.ranges) and self.ranges[i + 1][0] == self.ranges[i][1]:
+                self.ranges[i][1] = self.ranges.pop(i + 1)[1]
+        self.pending += 1
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        return urgent or self.pending >= ACK_EVERY
+
+    def timeout(self, idle):
+        """Seconds until the held-back ACK is due, idle when nothing is pending."""
+        if self.pending_since is None:
+            return idle
+        return max(0, self.pending_since + ACK_DELAY - time.monotonic())
+
+    def packet(self):
+        """Build the ACK datagram and reset the delayed-ACK state."""
+        self.pending = 0
+        self.pending_since = None
+        ranges = self.ranges[:MAX_SACK_RANGES]
+        header = ACK_HEADER.pack(PROTOCOL_VERSION, PACKET_ACK, len(ranges), self.session_id, self.cumulative)
+        return header + b"".join(SACK_RANGE.pack(start, end) for start, end in ranges)
+
+def file_sha256(path):
+    """SHA-256 of a local file, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def probe_datagram_size(server_host, server_port):
+    """
+    Largest of PROBE_SIZES the server's datagrams reach us with (the server sends them with
+    Don't Fragment, so larger ones are dropped on the way), 0 if no reply came.
+    """
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_socket.sendto(f"GET_CHUNK_SIZE".encode(), (server_host, server_port))
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    largest = 0
+    with client_socket:
+        client_socket.sendto(("PROBE " + " ".join(map(str, PROBE_SIZES))).encode(), (server_host, server_port))
+        deadline = time.monotonic() + PROBE_TIMEOUT
+        while largest < PROBE_SIZES[-1] and time.monotonic() < deadline:
+            client_socket.settimeout(deadline - time.monotonic())
+            try:
+                data = client_socket.recv(RECV_SIZE)
+            except socket.timeout:
+                break
+            header = data[:data.find(b"\n")].split()
+            if len(header) == 2 and header[0] == b"PROBE" and header[1] == str(len(data)).encode():
+                largest = max(largest, len(data))
+    return largest
+
+def fetch_chunk_size(server_host, server_port, hint=None):
+    """
+    Ask the server for the chunk size of our downloads, hint being the largest chunk we want
+    (None leaves the choice to the server).
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    request = "GET_CHUNK_SIZE" if hint is None else f"GET_CHUNK_SIZE max={hint}"
+    client_socket.sendto(request.encode(), (server_host, server_port))
 
     # Receive the chunk size from the server
     chunk_size_data, _ = client_socket.recvfrom(1024)
     return int(chunk_size_data.decode())
 
+def fetch_codec(server_host, server_port, codec):
+    """
+    Agree on a compression codec for DOWNLOAD: codec is offered first, then the others.
+    Returns the one the server picked, None when it compresses nothing (or doesn't answer).
+    """
+    offered = [codec] + [name for name in CODECS if name != codec]
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(REQUEST_TIMEOUT)
+    try:
+        for _ in range(REQUEST_RETRIES):
+            client_socket.sendto(f"COMPRESS {','.join(offered)}".encode(), (server_host, server_port))
+            try:
+                reply, _ = client_socket.recvfrom(1024)
+                break
+            except socket.timeout:
+                continue
+        else:
+            return None  # server without compression
+    finally:
+        client_socket.close()
+
+    chosen = reply.split()[1].decode() if reply.startswith(b"COMPRESS ") else None
+    return chosen if chosen in CODECS else None
+
+def load_list_cache():
+    """Return the (etag, listing) cached by a previous fetch_file_list, or (None, None)."""
+    try:
+        with open(LIST_CACHE, "rb") as f:
+            etag, _, listing = f.read().partition(b"\n")
+        return etag.decode(), listing
+    except OSError:
+        return None, None
+
+def fetch_listing_pages(client_socket, server_addr, etag):
+    """
+    Fetch every page of the server's listing, LIST_WINDOW page requests at a time, resending
+    requests whose page didn't arrive within LIST_TIMEOUT.
+    Returns (etag, listing), or (etag, None) if the cached etag is still current.
+    Raises TimeoutError when a page can't be fetched and RuntimeError when the catalog changes mid-fetch.
+    """
+    pages = {}
+    total = None
+    current_etag = None
+    attempts = {0: 1}
+    sent = {0: time.monotonic()}
+    client_socket.sendto(f"LIST page=0 etag={etag or ''}".encode(), server_addr)
+    client_socket.settimeout(LIST_TIMEOUT / 4)
+
+    while total is None or len(pages) < total:
+        try:
+            reply, _ = client_socket.recvfrom(65535)
+        except socket.timeout:
+            reply = None
+
+        if reply is not None:
+            if reply.startswith(b"NOT_MODIFIED"):
+                return reply.split()[1].decode(), None
+            if reply.startswith(b"ERROR"):
+                raise RuntimeError(reply.decode())
+            header, _, data = reply.partition(b"\n")
+            _, page, page_count, page_etag = header.decode().split()
+            page, page_count = int(page), int(page_count)
+            if current_etag is None:
+                current_etag, total = page_etag, page_count
+            elif page_etag != current_etag:
+                raise RuntimeError("catalog changed during LIST")
+            pages[page] = data
+            sent.pop(page, None)
+
+        # Keep LIST_WINDOW requests in flight and resend the ones that timed out
+        now = time.monotonic()
+        for page, when in list(sent.items()):
+            if now - when >= LIST_TIMEOUT:
+                if attempts[page] >= LIST_RETRIES:
+                    raise TimeoutError(f"no reply to LIST page {page}")
+                attempts[page] += 1
+                sent[page] = now
+                request = f"LIST page={page}" if page else f"LIST page=0 etag={etag or ''}"
+                client_socket.sendto(request.encode(), server_addr)
+        if total is not None:
+            for page in range(total):
+                if len(sent) >= LIST_WINDOW:
+                    break
+                if page not in pages and page not in sent:
+                    attempts[page] = 1
+                    sent[page] = now
+                    client_socket.sendto(f"LIST page={page}".encode(), server_addr)
+
+    return current_etag, b"".join(pages[page] for page in range(total))
+
 def fetch_file_list(server_host, server_port):
-    """Request and receive the list of available files from the server."""
+    """
+    Request and receive the list of available files from the server.
+    The listing is fetched as numbered pages (any size of catalog fits) and cached in LIST_CACHE
+    with its etag; later calls only download it again when the server's catalog changed.
+    """
+    etag, listing = load_list_cache()
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_socket.sendto(b"LIST", (server_host, server_port))
+    try:
+        for _ in range(REQUEST_RETRIES):
+            try:
+                new_etag, new_listing = fetch_listing_pages(client_socket, (server_host, server_port),
+                                                            etag if listing is not None else None)
+                break
+            except RuntimeError:
+                continue  # the catalog changed while paging, start over
+        else:
+            raise RuntimeError("catalog kept changing during LIST")
+    finally:
+        client_socket.close()
 
-    # Receive the file list from the server
-    file_list_data, _ = client_socket.recvfrom(4096)
+    if new_listing is not None:
+        etag, listing = new_etag, new_listing
+        with open(LIST_CACHE, "wb") as f:
+            f.write(etag.encode() + b"\n" + listing)
 
     # Parse the file list data
     files = {}
-    for line in file_list_data.decode().splitlines():
+    for line in listing.decode().splitlines():
         filename, size = line.strip().split()
         files[filename] = int(size)
 
@@ -61,6 +359,360 @@ def fetch_file_list(server_host, server_port):
             f.write(f"{file} {files[file]}\n")
     return files
 
+def fetch_file_stat(server_host, server_port, filename):
+    """Ask the server for the (size, mtime) of a file, None if the server doesn't have it."""
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(REQUEST_TIMEOUT)
+    try:
+        for _ in range(REQUEST_RETRIES):
+            client_socket.sendto(f"STAT {filename}".encode(), (server_host, server_port))
+            try:
+                reply, _ = client_socket.recvfrom(1024)
+                break
+            except socket.timeout:
+                continue
+        else:
+            raise TimeoutError(f"no reply to STAT {filename}")
+    finally:
+        client_socket.close()
+
+    if reply.startswith(b"ERROR"):
+        return None
+    size, mtime = reply.split()
+    return int(size), int(mtime)
+
+def fetch_file_hash(server_host, server_port, filename):
+    """Ask the server for the SHA-256 of a file, None if the server doesn't have it."""
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(HASH_TIMEOUT)
+    try:
+        for _ in range(REQUEST_RETRIES):
+            client_socket.sendto(f"HASH {filename}".encode(), (server_host, server_port))
+            try:
+                reply, _ = client_socket.recvfrom(1024)
+                break
+            except socket.timeout:
+                continue
+        else:
+            raise TimeoutError(f"no reply to HASH {filename}")
+    finally:
+        client_socket.close()
+
+    if not reply.startswith(b"SHA256 "):
+        return None
+    return reply.split()[1].decode()
+
+# SHA-256 of every block of a file (leaves) and the root of the Merkle tree over them
+BlockManifest = namedtuple("BlockManifest", ["size", "mtime", "block_size", "leaves", "root"])
+
+def fetch_block_manifest(server_host, server_port, filename):
+    """
+    Ask the server for the block manifest of a file, one BLOCKS page at a time. Returns None
+    if the server doesn't have the file, or if the pages don't add up to the announced Merkle
+    root (the file changed between two pages).
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(HASH_TIMEOUT)  # the first page waits for the server to hash the file
+    header = None
+    leaves = []
+    page = pages = 0
+    try:
+        while header is None or page < pages:
+            for _ in range(REQUEST_RETRIES):
+                client_socket.sendto(f"BLOCKS {filename} page={page}".encode(), (server_host, server_port))
+                try:
+                    reply, _ = client_socket.recvfrom(RECV_SIZE)
+                    break
+                except socket.timeout:
+                    continue
+            else:
+                raise TimeoutError(f"no reply to BLOCKS {filename}")
+            if not reply.startswith(b"BLOCKS "):
+                return None
+            first, _, body = reply.partition(b"\n")
+            size, mtime, block_size, count, root, reply_page, pages = first.split()[1:]
+            if int(reply_page) != page:
+                continue  # late reply to an earlier request, ask again
+            if header is None:
+                header = (size, mtime, block_size, count, root)
+            elif header != (size, mtime, block_size, count, root):
+                return None
+            leaves.extend(bytes.fromhex(line.decode()) for line in body.split())
+            page, pages = page + 1, int(pages)
+    finally:
+        client_socket.close()
+
+    size, mtime, block_size, count, root = header
+    if len(leaves) != int(count) or merkle_root(leaves).hex() != root.decode():
+        return None
+    return BlockManifest(int(size), int(mtime), int(block_size), leaves, bytes.fromhex(root.decode()))
+
+def merge_ranges(ranges):
+    """Sort byte ranges and merge the ones that touch or overlap."""
+    merged = []
+    for start, end in sorted(tuple(r) for r in ranges):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(done, size):
+    """Byte ranges of [0, size) not covered by the merged ranges in done."""
+    missing = []
+    position = 0
+    for start, end in done:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+def remove_ranges(done, removed, size):
+    """The merged ranges in done, without the bytes covered by removed."""
+    return [list(r) for r in missing_ranges(merge_ranges(missing_ranges(done, size) + list(removed)), size)]
+
+def limit_ranges(ranges, max_count):
+    """Coalesce sorted ranges across their smallest gaps until at most max_count remain."""
+    if len(ranges) <= max_count:
+        return ranges
+    gaps = sorted(ranges[i + 1][0] - ranges[i][1] for i in range(len(ranges) - 1))
+    threshold = gaps[len(gaps) - (max_count - 1) - 1]  # gaps up to this size are merged
+    limited = [list(ranges[0])]
+    for start, end in ranges[1:]:
+        if start - limited[-1][1] <= threshold:
+            limited[-1][1] = end
+        else:
+            limited.append([start, end])
+    return [tuple(r) for r in limited]
+
+class ChunkPlan:
+    """
+    Byte ranges cut into chunk_size chunks the same way the server does: plan[seq] is the
+    (offset, length) of the chunk, computed on demand so memory stays O(ranges), not O(chunks).
+    """
+    def __init__(self, ranges, chunk_size):
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.first_seqs = []  # sequence number of the first chunk of each range
+        self.total = 0
+        for start, end in ranges:
+            self.first_seqs.append(self.total)
+            self.total += -(-(end - start) // chunk_size)
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, seq):
+        if not 0 <= seq < self.total:
+            raise IndexError(seq)
+        i = bisect.bisect_right(self.first_seqs, seq) - 1
+        start, end = self.ranges[i]
+        offset = start + (seq - self.first_seqs[i]) * self.chunk_size
+        return offset, min(self.chunk_size, end - offset)
+
+class ChunkBitmap:
+    """Set of received sequence numbers, one bit per chunk."""
+    def __init__(self, size):
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, seq):
+        return self.bits[seq >> 3] & (1 << (seq & 7)) != 0
+
+    def add(self, seq):
+        """Mark seq received, False if it already was."""
+        mask = 1 << (seq & 7)
+        if self.bits[seq >> 3] & mask:
+            return False
+        self.bits[seq >> 3] |= mask
+        self.count += 1
+        return True
+
+def write_at(fd, data, position):
+    """Write all of data at position in fd (only the transfer's receiver thread writes its file)."""
+    if not hasattr(os, "pwrite"):
+        os.lseek(fd, position, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    while data:
+        n = os.pwrite(fd, data, position)
+        data = data[n:]
+        position += n
+
+def read_at(fd, size, position):
+    """Read size bytes at position in fd (only the transfer's receiver thread uses its file)."""
+    if not hasattr(os, "pread"):
+        os.lseek(fd, position, os.SEEK_SET)
+        return os.read(fd, size)
+    return os.pread(fd, size, position)
+
+class ParityGroups:
+    """
+    XOR parity of the chunk groups of a transfer that may still need it. The one missing chunk
+    of a group is rebuilt from the parity and the group's other chunks, read back from the
+    partial file, so only the parity is kept in memory.
+    """
+    def __init__(self):
+        self.firsts = []  # sorted first sequence numbers of the pending groups
+        self.groups = {}  # first sequence number -> (chunks in the group, parity)
+
+    def add(self, first, count, parity):
+        if first not in self.groups:
+            bisect.insort(self.firsts, first)
+        self.groups[first] = (count, bytes(parity))
+
+    def find(self, seq):
+        """First sequence number of the pending group containing seq, None if there is none."""
+        i = bisect.bisect_right(self.firsts, seq) - 1
+        if i >= 0 and seq < self.firsts[i] + self.groups[self.firsts[i]][0]:
+            return self.firsts[i]
+        return None
+
+    def recover(self, first, received, chunks, fd):
+        """
+        Rebuild the only missing chunk of a group: (seq, data), or None when there is nothing
+        to rebuild yet. The group is forgotten once it is complete.
+        """
+        count, parity = self.groups[first]
+        missing = [seq for seq in range(first, first + count) if seq not in received]
+        if len(missing) > 1:
+            return None
+        del self.groups[first]
+        del self.firsts[bisect.bisect_left(self.firsts, first)]
+        if not missing:
+            return None
+        value = int.from_bytes(parity, "big")
+        for seq in range(first, first + count):
+            if seq != missing[0]:
+                offset, length = chunks[seq]
+                value ^= int.from_bytes(read_at(fd, length, offset).ljust(len(parity), b"\0"), "big")
+        return missing[0], value.to_bytes(len(parity), "big")[:chunks[missing[0]][1]]
+
+def preallocate(fd, size):
+    """Reserve size bytes for the destination file so chunks can be written anywhere in it."""
+    if size == 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # Filesystem without fallocate support
+    os.ftruncate(fd, size)
+
+def manifest_path(filename):
+    return os.path.join(DOWNLOAD_DIR, f"{filename}.partial.json")
+
+def load_manifest(filename, size, mtime):
+    """
+    Return the byte ranges already downloaded into <filename>.partial, or [] when there is
+    no manifest or the file changed on the server since (different size or mtime).
+    """
+    try:
+        with open(manifest_path(filename), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if manifest.get("size") != size or manifest.get("mtime") != mtime:
+        print(f"[!] {filename} changed on the server, restarting download")
+        return []
+    return merge_ranges(manifest.get("done", []))
+
+def save_manifest(filename, size, mtime, done):
+    """Atomically record the completed byte ranges of a partial download."""
+    path = manifest_path(filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"size": size, "mtime": mtime, "done": done}, f)
+    os.replace(path + ".tmp", path)
+
+def remove_manifest(filename):
+    try:
+        os.remove(manifest_path(filename))
+    except FileNotFoundError:
+        pass
+
+def block_matches(path, manifest, block):
+    """Whether a block of the local file at path has the SHA-256 listed in manifest."""
+    start = block * manifest.block_size
+    length = min(manifest.block_size, manifest.size - start)
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(length)
+    return len(data) == length and hashlib.sha256(data).digest() == manifest.leaves[block]
+
+class BlockVerifier:
+    """
+    Check a download against the server's block manifest while it is written: add() records
+    the byte ranges written to the partial file, and every block they complete is read back
+    and hashed on a thread pool, in parallel with the transfer. Blocks already complete in
+    done (resumed, or reused by --update) are not checked again.
+    """
+    def __init__(self, path, manifest, done=()):
+        self.path = path
+        self.manifest = manifest
+        self.coverage = {}     # block -> merged ranges written so far, while incomplete
+        self.complete = set()  # blocks checked or being checked
+        self.bad = []          # byte ranges of the blocks that didn't match
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=VERIFY_THREADS)
+        for start, end in done:
+            self.add(start, end, check=False)
+
+    def add(self, start, end, check=True):
+        """Record that [start, end) was written, queue the blocks it completes for hashing."""
+        block_size = self.manifest.block_size
+        with self.lock:
+            for block in range(start // block_size, -(-end // block_size)):
+                if block in self.complete:
+                    continue
+                low = block * block_size
+                high = min(low + block_size, self.manifest.size)
+                covered = merge_ranges(self.coverage.get(block, []) + [(max(start, low), min(end, high))])
+                if covered == [[low, high]]:
+                    self.coverage.pop(block, None)
+                    self.complete.add(block)
+                    if check:
+                        self.pool.submit(self.check, block)
+                else:
+                    self.coverage[block] = covered
+
+    def check(self, block):
+        if not block_matches(self.path, self.manifest, block):
+            low = block * self.manifest.block_size
+            with self.lock:
+                self.bad.append((low, min(low + self.manifest.block_size, self.manifest.size)))
+
+    def finish(self):
+        """Wait for the queued checks, returns the merged byte ranges of the blocks that failed."""
+        self.pool.shutdown(wait=True)
+        return merge_ranges(self.bad)
+
+def reuse_local_copy(filename, manifest):
+    """
+    Turn downloads/<filename> into a partial download of the server's version described by
+    manifest: its blocks are hashed in parallel and the ones that match are recorded as
+    downloaded, so only the blocks that differ are fetched. Returns the number of bytes reused,
+    None when the local copy is already up to date (and is left alone).
+    """
+    local_path = os.path.join(DOWNLOAD_DIR, filename)
+    with ThreadPoolExecutor(max_workers=VERIFY_THREADS) as pool:
+        matches = list(pool.map(lambda block: block_matches(local_path, manifest, block), range(len(manifest.leaves))))
+    if all(matches) and os.path.getsize(local_path) == manifest.size:
+        return None
+    block_size = manifest.block_size
+    reused = merge_ranges((block * block_size, min((block + 1) * block_size, manifest.size))
+                          for block, match in enumerate(matches) if match)
+    partial_path = os.path.join(DOWNLOAD_DIR, f"{filename}.partial")
+    os.replace(local_path, partial_path)
+    os.truncate(partial_path, manifest.size)
+    save_manifest(filename, manifest.size, manifest.mtime, reused)
+    return sum(end - start for start, end in reused)
+
 def read_input_file():
     """Read INPUT_FILE and get the list of wanted filenames for download."""
     input_files = []
@@ -108,85 +760,416 @@ def display_available_files(files):
     print(f"\nTo download: Add filenames to input.txt, one per line.\n")
 
 
-def download_file(filename, file_size, server_host, server_port):
-    """Download the specified file from the server."""
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_socket.sendto(f"DOWNLOAD {filename}".encode(), (server_host, server_port))
+def download_file(filename, file_size, server_host, server_port, budget=None, verify=False, chunk_size=None,
+                  update=False, retries=0, codec=None):
+    """
+    Download the specified file from the server.
+    Chunks are written to <filename>.partial as they arrive and the completed byte ranges
+    are saved to <filename>.partial.json, so an interrupted download resumes with only the
+    missing ranges (unless STAT shows the file changed on the server in between).
+    The transfer waits for room in budget (shared with concurrent downloads) before starting.
+    With verify (or update), every block is checked against the server's block manifest (BLOCKS)
+    as it completes and the blocks that fail are downloaded again, up to MAX_BLOCK_RETRIES times;
+    a server without block manifests gets the whole-file SHA-256 check (HASH) instead.
+    With update, an existing downloads/<filename> is reused: only its blocks that differ from
+    the server's version are downloaded.
+    chunk_size defaults to the one negotiated in client_main; when the server ends the transfer
+    with RESIZE (chunks lost to fragmentation), the rest is downloaded again with smaller chunks.
+    codec is the compression agreed with the server (fetch_codec): chunks flagged with its id are
+    decompressed before they are checked and written; the bandwidth limit counts the datagrams.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    if budget is None:
+        budget = TransferBudget()
+    stat = fetch_file_stat(server_host, server_port, filename)
+    if stat is None:
+        print(f"[-] {filename} is no longer available on the server")
+        return False
+    file_size, mtime = stat
 
-    # Calculate total chunks based on file size and chunk size
-    total_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-    received_chunks = {}
+    partial_path = os.path.join(DOWNLOAD_DIR, f"{filename}.partial")
+    local_path = os.path.join(DOWNLOAD_DIR, filename)
+    manifest = None
+    if verify or update:
+        manifest = fetch_block_manifest(server_host, server_port, filename)
+        if manifest is not None and (manifest.size, manifest.mtime) != (file_size, mtime):
+            manifest = None  # changed since STAT
+    if update and os.path.exists(local_path) and not os.path.exists(partial_path):
+        if manifest is None:
+            print(f"[!] No block manifest for {filename}, downloading all of it again")
+        else:
+            reused = reuse_local_copy(filename, manifest)
+            if reused is None:
+                print(f"[+] {filename} is up to date")
+                return True
+            print(f"[!] Updating {filename}: {reused} of {file_size} bytes unchanged")
+
+    done = load_manifest(filename, file_size, mtime) if os.path.exists(partial_path) else []
+    missing = missing_ranges(done, file_size)
+    if done:
+        resumed = file_size - sum(end - start for start, end in missing)
+        print(f"[!] Resuming {filename}: {resumed} of {file_size} bytes already downloaded")
+        # Ranges are merged when there are too many to fit in one request (a few bytes are fetched twice)
+        missing = limit_ranges(missing, MAX_REQUEST_RANGES)
+
+    # Sequence numbers index the chunks of the requested ranges
+    chunks = ChunkPlan(missing, chunk_size)
+    total_chunks = len(chunks)
+    received_chunks = ChunkBitmap(total_chunks)
+    received_bytes = [0]
+    recovered = [0]  # chunks rebuilt from parity
+    new_ranges = []  # byte ranges written during this run, merged at every manifest save
     progress_intervals = [25, 50, 75, 100]  # Define percentage milestones
     progress_reported = set()  # Keep track of reported milestones
-    
+
+    reserved = sum(end - start for start, end in missing)
+    budget.reserve(reserved)
+
+    fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | (0 if done else os.O_TRUNC) | getattr(os, "O_BINARY", 0), 0o644)
+    if done:
+        os.ftruncate(fd, file_size)
+    else:
+        preallocate(fd, file_size)
+    verifier = BlockVerifier(partial_path, manifest, done) if manifest is not None else None
+
+    def save_progress(bad=()):
+        new_ranges[:] = merge_ranges(new_ranges)
+        save_manifest(filename, file_size, mtime, remove_ranges(merge_ranges(done + new_ranges), bad, file_size))
+
+    # The session id tags every packet of this transfer, the server runs one session per download
+    session_id = random.getrandbits(31) + 1
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+    request = f"DOWNLOAD {filename}"
+    if done:
+        request += " " + ",".join(f"{start}-{end}" for start, end in missing)
+    request = f"{request} session={session_id} chunk={chunk_size}" + (f" compress={codec}" if codec else "")
+    if DATAGRAM_SIZE:
+        request += f" probed={DATAGRAM_SIZE}"  # chunks within it are not resized for their losses
+    request = request.encode()
+    if total_chunks:
+        client_socket.sendto(request, (server_host, server_port))
+    last_packet = [time.monotonic()]
+    stop = threading.Event()
+    resize = [None]  # smaller chunk size asked for by the server
+    finished = threading.Event()  # set once every chunk is written, or when the receiver gives up
+
+    acks = AckState(session_id)
+
+    def send_ack():
+        client_socket.sendto(acks.packet(), (server_host, server_port))
+        metrics.inc("acks_sent_total")
+
     def receive_chunks():
-        """Receive file chunks from the server and send ACKs."""
-        while True:
-            packet, _ = client_socket.recvfrom(65535)
-            if packet == b"END":
-                print(f"[+] Downloaded {filename} successfully!")
-                break
+        """
+        Receive file chunks from the server into one reusable buffer, write each verified chunk
+        straight to its offset in the partial file and send (delayed) ACKs. Chunks lost in a
+        group covered by a parity packet are rebuilt without waiting for the retransmission.
+        """
+        last_save = time.monotonic()
+        buffer = bytearray(RECV_SIZE)
+        view = memoryview(buffer)
+        parity = ParityGroups()
+
+        def store_chunk(seq, offset, data, wire=None):
+            """Write a new chunk at its offset, account for it and ACK it when due (wire: bytes received for it)."""
+            nonlocal last_save
+            write_at(fd, data, offset)
+            new_ranges.append((offset, offset + len(data)))
+            if verifier:
+                verifier.add(offset, offset + len(data))
+            received_bytes[0] += len(data)
+            budget.release(len(data))
+            budget.received(len(data) if wire is None else wire)
+            if acks.add(seq) or received_chunks.count == total_chunks:
+                send_ack()
+            if received_chunks.count == total_chunks:
+                finished.set()
+            elif time.monotonic() - last_save >= MANIFEST_INTERVAL:
+                save_progress()
+                last_save = time.monotonic()
+
+            # Print milestones
+            progress = (received_chunks.count / total_chunks) * 100
+            for milestone in progress_intervals:
+                if progress >= milestone and milestone not in progress_reported:
+                    print(f"[{filename}] {milestone}% completed")
+                    progress_reported.add(milestone)
 
+        def recover_group(first):
+            rebuilt = parity.recover(first, received_chunks, chunks, fd)
+            if rebuilt is not None:
+                seq, data = rebuilt
+                received_chunks.add(seq)
+                recovered[0] += 1
+                metrics.inc("chunks_recovered_total")
+                store_chunk(seq, chunks[seq][0], data)
+
+        while not stop.is_set():
+            timeout = acks.timeout(0.5)
+            if acks.pending and timeout <= 0:
+                send_ack()  # the held-back ACK is due
+                timeout = acks.timeout(0.5)
+            # Never 0: that would make the socket non-blocking
+            client_socket.settimeout(max(timeout, 1e-3))
             try:
-                seq, checksum, data = packet.split(b"|", 2)
-                seq = int(seq.decode())
-                checksum = checksum.decode()
-
-                # Verify checksum before storing the chunk
-                if calculate_checksum(data) == checksum:
-                    received_chunks[seq] = data
-                    client_socket.sendto(f"ACK:{seq}".encode(), (server_host, server_port))
-                    progress = (len(received_chunks) / total_chunks) * 100
-
-                    # Print milestones
-                    for milestone in progress_intervals:
-                        if progress >= milestone and milestone not in progress_reported:
-                            print(f"[{filename}] {milestone}% completed")
-                            progress_reported.add(milestone)
-                else:
-                    print(f"[-] Corrupted chunk {seq}, requesting retransmission...")
+                size = client_socket.recv_into(buffer)
+            except socket.timeout:
+                if received_chunks.count >= total_chunks and time.monotonic() - last_packet[0] > REQUEST_TIMEOUT:
+                    break  # complete, END was lost
+                continue
+            except OSError:
+                break  # socket closed
+            last_packet[0] = time.monotonic()
+            metrics.inc("datagrams_received_total")
+            metrics.inc("bytes_received_total", size)
+            packet = view[:size]
+            if size and buffer[0] != PROTOCOL_VERSION:
+                # Text datagram (rare): END or ERROR
+                if packet == f"END {session_id}".encode():
+                    break
+                if bytes(packet[:7]) == b"RESIZE ":
+                    _, sid, size = bytes(packet).split()
+                    if int(sid) == session_id:
+                        resize[0] = int(size)
+                        stop.set()
+                        break
+                    continue
+                if bytes(packet[:5]) == b"ERROR":
+                    print(f"[-] {filename}: {bytes(packet).decode(errors='replace')}")
+                    stop.set()
+                    break
+
+            try:
+                parsed = parse_data_packet(packet)
+                if parsed is None:
+                    metrics.inc("corrupted_chunks_total")
+                    if verbosity:
+                        print("[-] Corrupted chunk, waiting for its retransmission...")
+                    continue
+                packet_type, flags, sid, seq, offset, data = parsed
+                if sid != session_id:
+                    continue  # left over from another transfer
+
+                wire = len(data)
+                if packet_type == PACKET_DATA and flags:
+                    data = CODEC_IDS[flags].decompress(data)  # compressed chunk, flags = codec id
+
+                if packet_type == PACKET_PARITY:
+                    if flags and seq + flags <= total_chunks:
+                        parity.add(seq, flags, data)
+                        recover_group(seq)
+                elif seq < total_chunks and chunks[seq] == (offset, len(data)):
+                    if received_chunks.add(seq):
+                        store_chunk(seq, offset, data, wire)
+                        first = parity.find(seq)
+                        if first is not None:
+                            recover_group(first)
+                    else:
+                        metrics.inc("duplicate_chunks_total")
+                        send_ack()  # a retransmission of a received chunk: our ACK was lost
+                elif verbosity:
+                    print(f"[-] Unexpected chunk {seq} at offset {offset}, ignored")
             except Exception as e:
                 print(f"Error processing packet: {e}")
 
+    def receive_thread():
+        try:
+            receive_chunks()
+        finally:
+            client_socket.close()
+            finished.set()
+
     # Start a thread to receive chunks while main thread handles flow control
-    threading.Thread(target=receive_chunks, daemon=True).start()
+    receiver = threading.Thread(target=receive_thread, daemon=True)
+    receiver.start()
 
-    # Wait until all chunks are received
-    while len(received_chunks) < total_chunks:
-        time.sleep(0.01)
-    
-    # Notify the server that the download is complete
-    client_socket.sendto(f"DONE {filename}".encode(), (server_host, server_port))
+    requests_sent = 1
+    try:
+        # Wait for the receiver to signal completion; wake up now and then to resend a lost
+        # DOWNLOAD request or give up on a silent server
+        while total_chunks and not finished.wait(REQUEST_TIMEOUT / 4):
+            idle = time.monotonic() - last_packet[0]
+            if (not received_chunks.count and idle >= REQUEST_TIMEOUT * requests_sent
+                    and requests_sent < REQUEST_RETRIES):
+                # The DOWNLOAD request itself may have been lost
+                client_socket.sendto(request, (server_host, server_port))
+                requests_sent += 1
+            elif idle >= SESSION_TIMEOUT:
+                print(f"[-] No data from the server for {SESSION_TIMEOUT}s, giving up on {filename}")
+                break
+    finally:
+        if received_chunks.count < total_chunks:
+            # Given up or interrupted: the receiver must be gone before its file is closed
+            stop.set()
+            receiver.join()
+        bad = verifier.finish() if verifier else []
+        os.close(fd)
+        budget.release(reserved - received_bytes[0])
+        # Also saved when interrupted, so the next run can resume (corrupt blocks excluded)
+        save_progress(bad)
 
-    # Write the received chunks to a file
-    with open(os.path.join(DOWNLOAD_DIR, filename), "wb") as f:
-        for seq in range(total_chunks):
-            f.write(received_chunks[seq])
-    
+    if stop.is_set():
+        client_socket.close()
+        if resize[0]:
+            metrics.inc("resizes_total")
+            print(f"[!] {filename}: chunks lost to fragmentation, resuming with {resize[0]}-byte chunks")
+            return download_file(filename, file_size, server_host, server_port, budget, verify, resize[0], update,
+                                 retries, codec)
+        return False
+    if recovered[0]:
+        print(f"[+] {filename}: {recovered[0]} chunk(s) rebuilt from parity")
+    if total_chunks:
+        # Notify the server that the download is complete
+        try:
+            client_socket.sendto(f"DONE {filename} session={session_id}".encode(), (server_host, server_port))
+        except OSError:
+            pass  # the receiver already closed the socket, the server's session times out
+
+    if bad:
+        corrupt = sum(end - start for start, end in bad)
+        if retries >= MAX_BLOCK_RETRIES:
+            print(f"[-] {filename}: {corrupt} bytes still fail block verification after {retries} retries, giving up")
+            return False
+        print(f"[-] {filename}: {corrupt} bytes failed block verification, downloading them again")
+        return download_file(filename, file_size, server_host, server_port, budget, verify, chunk_size, update,
+                             retries + 1, codec)
+    if verifier:
+        print(f"[+] {filename} verified ({len(manifest.leaves)} blocks, SHA-256)")
+    elif verify:
+        # Whole-file check, once: chunks only carry a CRC-32
+        expected = fetch_file_hash(server_host, server_port, filename)
+        if expected is not None and file_sha256(partial_path) != expected:
+            print(f"[-] {filename} failed SHA-256 verification, it will be downloaded again")
+            os.remove(partial_path)
+            remove_manifest(filename)
+            return False
+        print(f"[+] {filename} verified (SHA-256)")
+
+    os.replace(partial_path, local_path)
+    remove_manifest(filename)
+    print(f"[+] Downloaded {filename} successfully!")
+    return True
+
+class DownloadQueue:
+    """
+    Download several files at once: up to max_files run concurrently, started in priority
+    order ("smallest" file first, or "input" order), all sharing one TransferBudget.
+    """
+    def __init__(self, server_host, server_port, max_files, priority, budget, verify=False, update=False, codec=None):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_files = max_files
+        self.priority = priority
+        self.budget = budget
+        self.verify = verify
+        self.update = update
+        self.codec = codec
 
-def client_main(server_host, server_port):
-    """Main function to control the client download process."""
+    def run(self, files):
+        """Download the (filename, size) pairs in files, returns the filenames that completed."""
+        queue = list(files)
+        if self.priority == "smallest":
+            queue.sort(key=lambda item: item[1])
+        queue.reverse()  # pop() from the end
+        completed = []
+        lock = threading.Lock()
+        start_bytes = self.budget.bytes_received
+        start = time.monotonic()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    filename, size = queue.pop()
+                print(f"Starting download for: {filename}")
+                started = time.monotonic()
+                metrics.add("active_downloads", 1)
+                try:
+                    ok = download_file(filename, size, self.server_host, self.server_port, self.budget, self.verify,
+                                       update=self.update, codec=self.codec)
+                except Exception as e:
+                    # Don't let one file take the worker, and the files queued behind it, down
+                    print(f"[-] Failed to download {filename}: {e}")
+                    ok = False
+                finally:
+                    metrics.add("active_downloads", -1)
+                if ok:
+                    metrics.inc("files_completed_total")
+                    metrics.observe("download_seconds", time.monotonic() - started)
+                    with lock:
+                        completed.append(filename)
+                else:
+                    metrics.inc("files_failed_total")
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(self.max_files, len(queue)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        received = self.budget.bytes_received - start_bytes
+        print(f"[+] {len(completed)}/{len(files)} file(s), {received / 1e6:.1f} MB in {elapsed:.2f}s "
+              f"({received / 1e6 / elapsed:.1f} MB/s aggregate)")
+        return completed
+
+def client_main(server_host, server_port, max_files=MAX_FILES, max_inflight=MAX_INFLIGHT, rate_limit=0,
+                priority="smallest", verify=False, chunk_size=0, once=False, update=False, compress=None,
+                metrics_path=None, verbose=0):
+    """
+    Main function to control the client download process.
+    With once, the files wanted at startup are downloaded and the client returns instead of
+    watching INPUT_FILE. With update, wanted files that were already downloaded are brought up
+    to date with the server (only the blocks that changed are downloaded).
+    compress is the codec to ask the server for, None for raw transfers.
+    With metrics_path, the client's metrics are written there after every batch of downloads.
+    """
+    global verbosity
+    verbosity = verbose
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     server_files = fetch_file_list(server_host, server_port)
     
-    # Fetch chunk size from server's end
-    global CHUNK_SIZE
-    CHUNK_SIZE = fetch_chunk_size(server_host, server_port)
+    # Negotiate the chunk size: the largest that fits in one datagram on the path (probed,
+    # unless given with --chunk-size), within the server's limits
+    global CHUNK_SIZE, DATAGRAM_SIZE
+    hint = chunk_size
+    if not hint:
+        DATAGRAM_SIZE = probe_datagram_size(server_host, server_port)
+        if DATAGRAM_SIZE:
+            print(f"[!] Largest unfragmented datagram from the server: {DATAGRAM_SIZE} bytes")
+            hint = DATAGRAM_SIZE - DATA_HEADER.size
+    CHUNK_SIZE = fetch_chunk_size(server_host, server_port, hint or None)
     print(f"[!] Using chunk size: {CHUNK_SIZE} bytes")
+    codec = fetch_codec(server_host, server_port, compress) if compress else None
+    if compress:
+        print(f"[!] Compression: {codec or 'none (not supported by the server)'}")
     
     files_displayed = False
+    budget = TransferBudget(max_inflight, rate_limit)
+    download_queue = DownloadQueue(server_host, server_port, max_files, priority, budget, verify, update, codec)
     while True:
         input_files = read_input_file()
+        try:
+            # Cheap when nothing changed: the server answers NOT_MODIFIED
+            server_files = fetch_file_list(server_host, server_port)
+        except (OSError, RuntimeError) as e:
+            print(f"[-] Failed to refresh the file list: {e}")
         
         if not input_files and not files_displayed:
             display_available_files(server_files)
             files_displayed = True
             
-        for filename in input_files:
-            if filename in server_files and filename not in downloaded_files and not os.path.exists(os.path.join(DOWNLOAD_DIR, filename)):
-                print(f"Starting download for: {filename}")
-                download_file(filename, server_files[filename], server_host, server_port)
-                downloaded_files.add(filename)
+        wanted = [(filename, server_files[filename]) for filename in dict.fromkeys(input_files)
+                  if filename in server_files and filename not in downloaded_files
+                  and (update or not os.path.exists(os.path.join(DOWNLOAD_DIR, filename)))]
+        if wanted:
+            downloaded_files.update(download_queue.run(wanted))
+            if metrics_path:
+                save_metrics(metrics_path)
+        if once:
+            return
         # Wait 5 seconds after checking INPUT_FILE for additional files
         time.sleep(5)
 
@@ -194,10 +1177,30 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="UDP Client")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Server IP address")
     parser.add_argument("--port", type=int, default=8000, help="Server port")
+    parser.add_argument("--max-files", type=int, default=MAX_FILES, help="Files downloaded at the same time")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT,
+                        help="Bytes admitted but not yet received, over all files")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Total download bandwidth in bytes/s (0 = unlimited)")
+    parser.add_argument("--priority", choices=PRIORITIES, default="smallest",
+                        help="Order in which queued files are started")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check every block of the downloads against the server's SHA-256s")
+    parser.add_argument("--chunk-size", type=int, default=0,
+                        help="Largest chunk size to ask the server for (0 = probe the path MTU)")
+    parser.add_argument("--once", action="store_true", help="Download the files in input.txt, then exit")
+    parser.add_argument("--update", action="store_true",
+                        help="Bring files already downloaded up to date, fetching only changed blocks")
+    parser.add_argument("--compress", choices=tuple(CODECS),
+                        help="Ask the server to compress the transfers with this codec")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write the client's metrics to FILE after each batch (.prom: Prometheus text, else JSON)")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Also log every corrupted or unexpected chunk")
     args = parser.parse_args()
     print(socket_art)
     try:
-        client_main(args.host, args.port)
+        client_main(args.host, args.port, args.max_files, args.max_inflight, args.rate_limit, args.priority,
+                    args.verify, args.chunk_size, args.once, args.update, args.compress, args.metrics, args.verbose)
     except KeyboardInterrupt:
         os.remove(FILE_LIST)
         print("\nClient exited.")
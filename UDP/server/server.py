@@ -1,20 +1,299 @@
 import argparse
+import bisect
+import bz2
+import heapq
+import lzma
 import socket
 import os
+import sys
 import threading
-import hashlib
+import mmap
+import multiprocessing
+import queue
 import random
+import struct
+import time
+import zlib
+from collections import deque, namedtuple
+
+# The code shared by the servers and the clients lives in common/, at the top of the project
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.compression import CompressionCache
+from common.files import FILE_CACHE_SIZE, FileCache, FileIndex
+from common.metrics import METRICS_FORMATS, Metrics
+from common.pacing import SCHEDULER_QUANTUM, FairScheduler
 
 # Server configuration
 FILE_DIR = "server_files"
-FILE_LIST = "file_list.txt"
-CHUNK_SIZE = 10 * 1024  
-WINDOW_SIZE = 5          # Number of chunks that can be in flight simultaneously
-ACK_TIMEOUT = 7         # Timeout in seconds for waiting for ACKs before retransmission
+INDEX_INTERVAL = 1.0    # Seconds between two refreshes of the file index
+LIST_PAGE_SIZE = 8192   # Listing bytes per LIST page datagram
+BLOCKS_PAGE = 120       # Block hashes per BLOCKS page datagram (65 bytes each, under LIST_PAGE_SIZE)
+CHUNK_SIZE = 10 * 1024  # Chunk size of clients that don't negotiate one
+# Commands counted by name in the metrics (anything else is "other")
+COMMANDS = ("LIST", "DOWNLOAD", "DONE", "STAT", "HASH", "BLOCKS", "SESSIONS", "CACHE", "STATS", "GET_CHUNK_SIZE",
+            "PROBE", "COMPRESS")
+PROTOCOL_VERSION = 1    # First byte of binary datagrams (text commands start with a letter)
+PACKET_DATA = 1         # Packet type of a file chunk
+PACKET_ACK = 2          # Packet type of an acknowledgement
+PACKET_PARITY = 3       # Packet type of the XOR parity of a group of chunks (flags = chunks in the group)
+FEC_MIN_GROUP = 2       # Smallest parity group (one parity packet per 2 chunks, 50% redundancy)
+# version, type, flags, session, sequence number, file offset, payload length, CRC-32
+DATA_HEADER = struct.Struct("!BBHIIQII")
+# version, type, number of SACK ranges, session, cumulative ACK (every lower sequence number received)
+ACK_HEADER = struct.Struct("!BBHII")
+SACK_RANGE = struct.Struct("!II")  # first and end (exclusive) sequence numbers received above the cumulative ACK
+MAX_DATAGRAM = 65507    # Largest UDP payload over IPv4
+MIN_CHUNK_SIZE = 512
+MAX_CHUNK_SIZE = MAX_DATAGRAM - DATA_HEADER.size
+SAFE_CHUNK_SIZE = 1472 - DATA_HEADER.size  # Chunk of a datagram that fits a 1500-byte Ethernet MTU unfragmented
+MAX_PROBES = 8          # Datagram sizes answered per PROBE request
+RESIZE_LOSS = 0.2       # Loss (above the simulated corruption) blamed on fragmentation of chunks above SAFE_CHUNK_SIZE
+RESIZE_MIN_CHUNKS = 64  # Chunks sent before a session's loss rate is trusted for resizing
+RESIZE_COPIES = 3       # Times RESIZE is sent, it ends the session
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)  # Linux values, missing from the socket module
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)     # Always set Don't Fragment
+INITIAL_WINDOW = 10     # Chunks in flight before any feedback (the congestion controller grows it)
+MIN_WINDOW = 2          # The window never shrinks below this many chunks
+MAX_WINDOW = 8192       # Upper bound of the window, in chunks
+CONGESTION_CONTROLLERS = ("reno", "rate")
+RATE_SAMPLES = 10       # Delivery-rate samples kept by the rate controller's max filter
+RATE_INTERVAL = 0.01    # Shortest delivery-rate sampling interval, in seconds
+PACING_QUANTUM = 0.001  # Paced chunks may go out this many seconds ahead of schedule, in bursts
+INITIAL_RTO = 1.0       # Retransmission timeout in seconds before the first RTT sample
+MIN_RTO = 0.05
+MAX_RTO = 7             # Upper bound of the retransmission timeout, backoff included
+DONE_TIMEOUT = 2        # Seconds to wait for the client's DONE once every chunk is acknowledged
+SESSION_TIMEOUT = 30    # A session without any ACK for this long is dropped
+
+Codec = namedtuple("Codec", ["id", "compress"])
+# Compression codecs, by name: id on the wire (0 = raw) and compress function
+CODECS = {
+    "zlib": Codec(1, lambda data: zlib.compress(data, 6)),
+    "bz2": Codec(2, lambda data: bz2.compress(data, 9)),
+    "lzma": Codec(3, lambda data: lzma.compress(data, preset=1)),
+}
+Session = namedtuple("Session", ["inbox", "controller"])
+
+class CachedFile:
+    """
+    A file's read-only mapping (None when empty), shared by the transfers reading it; size and
+    mtime are those of the mapped file.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.size = st.st_size
+            self.mtime = st.st_mtime_ns
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.refs = 0         # transfers using the mapping
+        self.cached = False   # still in the cache (closed by the last release() otherwise)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+
+def parse_options(args):
+    """Parse key=value request arguments into a dict."""
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        options[key] = value
+    return options
+
+# Catalog of FILE_DIR, kept up to date by a background thread
+file_index = FileIndex(FILE_DIR, page_size=LIST_PAGE_SIZE)
+# Mappings of FILE_DIR shared by the sessions, invalidated when the index changes
+file_cache = FileCache(FILE_DIR, CachedFile)
+# Compressed chunks shared by the sessions
+compression_cache = CompressionCache()
+# Counters and latency histograms served by STATS (per worker process)
+metrics = Metrics("udp_server_")
+# Fair-share pacing of the file data (--rate-limit, --client-rate, --weight)
+scheduler = FairScheduler(metrics=metrics)
+verbosity = 0  # -v: also log every retransmitted chunk
+# Transfers in progress: (client address, session id) -> Session(inbox of its datagrams, congestion controller)
+sessions = {}
+sessions_lock = threading.Lock()
+
+def build_data_header(session_id, seq_num, offset, payload, packet_type=PACKET_DATA, flags=0):
+    """
+    Build the DATA_HEADER of a chunk (or parity) datagram, sent followed by the payload. The CRC-32
+    covers the rest of the header and the payload, so a corrupted session, sequence number or
+    offset is caught too.
+    """
+    header = DATA_HEADER.pack(PROTOCOL_VERSION, packet_type, flags, session_id, seq_num, offset, len(payload), 0)
+    crc = zlib.crc32(payload, zlib.crc32(header[:-4]))
+    return header[:-4] + crc.to_bytes(4, "big")
+
+def xor_parity(mapping, chunks, first, count):
+    """XOR of the chunks first..first+count-1, each zero-padded to the longest of them."""
+    length = max(chunks[seq][1] for seq in range(first, first + count))
+    value = 0
+    for seq in range(first, first + count):
+        offset, size = chunks[seq]
+        value ^= int.from_bytes(mapping[offset:offset + size].ljust(length, b"\0"), "big")
+    return value.to_bytes(length, "big")
+
+def send_datagram(server_socket, client_addr, buffers):
+    """Send buffers as one datagram, gathered by sendmsg without joining them (joined where sendmsg is missing)."""
+    if hasattr(server_socket, "sendmsg"):
+        server_socket.sendmsg(buffers, (), 0, client_addr)
+    else:
+        server_socket.sendto(b"".join(buffers), client_addr)
+
+class RttEstimator:
+    """
+    Smoothed RTT and RTT variance (Jacobson/Karels, as in RFC 6298) giving the retransmission
+    timeout. Every chunk has its own timer, so the backoff is per chunk: the timeout doubles
+    with each retransmission of that chunk.
+    """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def timeout(self, retransmissions=0):
+        return min(MAX_RTO, self.rto * 2 ** min(retransmissions, 6))
+
+class CongestionController:
+    """
+    Base of the congestion controllers driving handle_download: cwnd is the number of chunks
+    allowed in flight, pacing_rate the send rate in bytes/s (0 sends as fast as the window opens).
+    The sender reports every acknowledged chunk with on_ack and every expired chunk with on_loss.
+    """
+    name = None
+
+    def __init__(self, chunk_size=CHUNK_SIZE, max_window=MAX_WINDOW):
+        self.chunk_size = chunk_size
+        self.max_window = max_window
+        self.cwnd = INITIAL_WINDOW
+        self.pacing_rate = 0.0
+        self.acked = 0
+        self.lost = 0
+        self.recovery_start = 0.0  # chunks sent before the last reduction don't reduce again
+
+    def loss_rate(self):
+        return self.lost / max(1, self.acked + self.lost)
+
+    def window(self):
+        return max(MIN_WINDOW, min(self.max_window, int(self.cwnd)))
+
+    def on_ack(self, size, sent_at, rtt, now):
+        self.acked += 1
 
-def calculate_checksum(data):
-    """Calculate the MD5 checksum of the given data."""
-    return hashlib.md5(data).hexdigest()
+    def on_loss(self, sent_at, now):
+        """Count a lost chunk; True when it starts a new loss episode (one reduction per window)."""
+        self.lost += 1
+        if sent_at < self.recovery_start:
+            return False
+        self.recovery_start = now
+        return True
+
+    def stats(self):
+        return {"cc": self.name, "cwnd": self.window(), "pacing_rate": int(self.pacing_rate),
+                "loss_rate": round(self.loss_rate(), 4)}
+
+class RenoController(CongestionController):
+    """AIMD: slow start up to ssthresh, then one chunk per window per RTT; halved on loss."""
+    name = "reno"
+
+    def __init__(self, chunk_size=CHUNK_SIZE, max_window=MAX_WINDOW):
+        super().__init__(chunk_size, max_window)
+        self.ssthresh = max_window
+
+    def on_ack(self, size, sent_at, rtt, now):
+        super().on_ack(size, sent_at, rtt, now)
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, sent_at, now):
+        if super().on_loss(sent_at, now):
+            self.ssthresh = max(MIN_WINDOW, self.cwnd / 2)
+            self.cwnd = self.ssthresh
+
+class RateController(CongestionController):
+    """
+    Rate-based control in the style of BBR: the delivery rate is sampled once per minimum RTT
+    (at least RATE_INTERVAL, LAN round trips are too short to measure) and the bottleneck
+    bandwidth is the max of the last RATE_SAMPLES samples. Chunks are paced at gain * bandwidth
+    (2 during startup, then a 1.25/0.75/1... probing cycle) and the window is twice the
+    bandwidth times the smoothed RTT (which, unlike the minimum, includes the receiver's
+    processing time), never below INITIAL_WINDOW since pacing already bounds the rate. Loss
+    only trims the bandwidth estimate.
+    """
+    name = "rate"
+    STARTUP_GAIN = 2.0
+    PROBE_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+
+    def __init__(self, chunk_size=CHUNK_SIZE, max_window=MAX_WINDOW):
+        super().__init__(chunk_size, max_window)
+        self.samples = deque(maxlen=RATE_SAMPLES)
+        self.min_rtt = None
+        self.srtt = None
+        self.interval_start = None
+        self.interval_bytes = 0
+        self.startup = True
+        self.full_bw = 0.0
+        self.full_bw_rounds = 0
+        self.cycle = 0
+
+    def bandwidth(self):
+        return max(self.samples) if self.samples else 0.0
+
+    def on_ack(self, size, sent_at, rtt, now):
+        super().on_ack(size, sent_at, rtt, now)
+        if rtt is not None:
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+            self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        if self.interval_start is None:
+            self.interval_start = now
+            return
+        self.interval_bytes += size
+        elapsed = now - self.interval_start
+        if self.min_rtt is None or elapsed < max(self.min_rtt, RATE_INTERVAL):
+            return
+        self.samples.append(self.interval_bytes / elapsed)
+        self.interval_start, self.interval_bytes = now, 0
+        self.update()
+
+    def update(self):
+        """Advance the gain cycle and derive the pacing rate and window from the estimates."""
+        bandwidth = self.bandwidth()
+        if self.startup:
+            # Leave startup once the bandwidth stopped growing by 25% for three samples
+            if bandwidth >= self.full_bw * 1.25:
+                self.full_bw, self.full_bw_rounds = bandwidth, 0
+            else:
+                self.full_bw_rounds += 1
+                self.startup = self.full_bw_rounds < 3
+            gain = self.STARTUP_GAIN
+        else:
+            self.cycle = (self.cycle + 1) % len(self.PROBE_GAINS)
+            gain = self.PROBE_GAINS[self.cycle]
+        self.pacing_rate = gain * bandwidth
+        self.cwnd = max(INITIAL_WINDOW, 2 * bandwidth * self.srtt / self.chunk_size)
+
+    def on_loss(self, sent_at, now):
+        if super().on_loss(sent_at, now) and self.samples:
+            self.samples = deque((rate * 0.85 for rate in self.samples), maxlen=RATE_SAMPLES)
+            self.startup = False
+            self.update()
+
+def make_controller(name, chunk_size=CHUNK_SIZE, max_window=MAX_WINDOW):
+    """Create the congestion controller selected with --cc, for chunks of chunk_size bytes."""
+    return {"reno": RenoController, "rate": RateController}[name](chunk_size, max_window)
 
 def corrupt_packet(packet, corruption_rate):
     """Simulate packet corruption by randomly modifying a byte."""
@@ -30,130 +309,667 @@ def corrupt_packet(packet, corruption_rate):
         return bytes(packet_list)
     return packet
 
-def update_file_list():
-    """Update the list of files in FILE_DIR and save to FILE_LIST."""
-    with open(FILE_LIST, "w") as f:
-        for filename in os.listdir(FILE_DIR):
-            filepath = os.path.join(FILE_DIR, filename)
-            if os.path.isfile(filepath):
-                size = os.path.getsize(filepath)
-                f.write(f"{filename} {size}\n")  
-
-def handle_get_chunk_size(server_socket, client_addr):
-    """Send the current CHUNK_SIZE to the client."""
-    server_socket.sendto(str(CHUNK_SIZE).encode(), client_addr)
-
-def handle_list(server_socket, client_addr):
-    """Send the list of available files to the client."""
-    with open(FILE_LIST, "rb") as f:
-        server_socket.sendto(f.read(), client_addr)
-
-def handle_download(server_socket, client_addr, filename, corruption_rate):
-    """Handle file download request from the client."""
+def parse_ack(data):
+    """Parse an ACK datagram into (session, cumulative ACK, [(first, end), ...] SACK ranges)."""
+    _, packet_type, count, session_id, cumulative = ACK_HEADER.unpack_from(data)
+    if packet_type != PACKET_ACK:
+        raise ValueError(f"unexpected packet type {packet_type}")
+    ranges = [SACK_RANGE.unpack_from(data, ACK_HEADER.size + i * SACK_RANGE.size) for i in range(count)]
+    return session_id, cumulative, ranges
+
+def handle_get_chunk_size(server_socket, client_addr, args, max_chunk=MAX_CHUNK_SIZE):
+    """
+    Send the chunk size of the client's next downloads: GET_CHUNK_SIZE max=<n> gets the client's
+    hint (from its path MTU probe) capped at max_chunk, a bare GET_CHUNK_SIZE gets CHUNK_SIZE.
+    """
+    options = parse_options(args)
+    if "max" in options:
+        chunk_size = max(MIN_CHUNK_SIZE, min(int(options["max"]), max_chunk))
+    else:
+        chunk_size = min(CHUNK_SIZE, max_chunk)
+    server_socket.sendto(str(chunk_size).encode(), client_addr)
+
+def handle_probe(client_addr, args):
+    """
+    Answer PROBE <size> ...: one datagram of each size ("PROBE <size>\n" padded), sent with
+    Don't Fragment from a separate socket so that only the sizes the path carries in one
+    piece arrive. The client picks its chunk size from the largest one it receives.
+    """
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with probe_socket:
+        try:
+            probe_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        except OSError:
+            pass  # Not Linux: sizes above the path MTU may arrive fragmented
+        for size in sorted({int(arg) for arg in args[:MAX_PROBES]}):
+            if not DATA_HEADER.size <= size <= MAX_DATAGRAM:
+                continue
+            try:
+                probe_socket.sendto(f"PROBE {size}\n".encode().ljust(size, b"\0"), client_addr)
+            except OSError:
+                break  # EMSGSIZE: larger than the known path MTU, so are the next sizes
+
+def handle_stat(server_socket, client_addr, filename):
+    """Send the size and modification time of a file, so clients can validate partial downloads."""
     filepath = os.path.join(FILE_DIR, filename)
-    if not os.path.exists(filepath):
+    if not os.path.isfile(filepath):
         server_socket.sendto(b"ERROR: File not found", client_addr)
         return
+    st = os.stat(filepath)
+    server_socket.sendto(f"{st.st_size} {st.st_mtime_ns}".encode(), client_addr)
 
-    file_size = os.path.getsize(filepath)
-    total_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-    print(f"[+] Starting download of {filename}, Size: {file_size} bytes, Chunks: {total_chunks}")
-
-    sent_chunks = {}
-    acked_chunks = set()
-    window_start = 0
-
-    def resend_chunk(seq_num):
-        """Resend a specific chunk if it hasn't been acknowledged."""
-        if seq_num in sent_chunks and seq_num not in acked_chunks:
-            # Potentially corrupt the packet when resending
-            packet = sent_chunks[seq_num]
-            corrupted_packet = corrupt_packet(packet, corruption_rate)
-            server_socket.sendto(corrupted_packet, client_addr)
-            print(f"[-] Resending chunk {seq_num}")
-
-    def wait_for_ack():
-        """Wait for ACKs from the client and update the loading bar."""
-        while True:
-            try:
-                server_socket.settimeout(ACK_TIMEOUT)
-                ack, _ = server_socket.recvfrom(1024)
-                
-                if ack.startswith(b"ACK:"):
-                    seq_num = int(ack.split(b":")[1])
-                    acked_chunks.add(seq_num)
-                    
-                elif ack.startswith(b"DONE") or len(acked_chunks) < total_chunks:
-                    print(f"[+] Client finished receiving {filename}.")
-                    break  
-            except socket.timeout:
-                # Resend unacknowledged chunks
-                for seq in range(window_start, min(window_start + WINDOW_SIZE, total_chunks)):
-                    resend_chunk(seq)
-
-    # Start a thread to listen for ACKs
-    ack_thread = threading.Thread(target=wait_for_ack, daemon=True)
-    ack_thread.start()
-
-    # Main loop for sending chunks
-    while window_start < total_chunks:
-        for seq in range(window_start, min(window_start + WINDOW_SIZE, total_chunks)):
-            if seq in acked_chunks:
-                continue  
-
-            # Read and send the chunk
-            with open(filepath, "rb") as file:
-                file.seek(seq * CHUNK_SIZE)  
-                chunk_data = file.read(CHUNK_SIZE)
-                checksum = calculate_checksum(chunk_data)
-                packet = f"{seq}|{checksum}|".encode() + chunk_data 
-                
-                # Potentially corrupt the packet
-                corrupted_packet = corrupt_packet(packet, corruption_rate)
-                
-                sent_chunks[seq] = packet
-                server_socket.sendto(corrupted_packet, client_addr)  
-
-        # Update the window_start to the next unacknowledged chunk
-        while window_start in acked_chunks:
-            window_start += 1
-            
-    # Wait for the ACK thread to finish
-    ack_thread.join()  
+def handle_hash(server_socket, client_addr, filename):
+    """
+    Send the SHA-256 of a file ("SHA256 <hex>"), so the client can check the whole download once
+    instead of hashing every chunk. Cached by the index; runs in its own thread, since hashing
+    a large file the first time takes a while.
+    """
+    digest = file_index.file_hash(filename)
+    if digest is None:
+        server_socket.sendto(b"ERROR: File not found", client_addr)
+        return
+    server_socket.sendto(f"SHA256 {digest}".encode(), client_addr)
+
+def handle_blocks(server_socket, client_addr, filename, args):
+    """
+    Send one page of the block manifest of a file:
+    "BLOCKS <size> <mtime> <block size> <blocks> <merkle root> <page> <pages>\n" followed by
+    up to BLOCKS_PAGE block SHA-256s in hex, one per line. The client checks every block as it
+    completes and only fetches the blocks that differ from a local copy. Runs in its own
+    thread like HASH.
+    """
+    manifest = file_index.block_manifest(filename)
+    if manifest is None:
+        server_socket.sendto(b"ERROR: File not found", client_addr)
+        return
+    try:
+        page = int(parse_options(args).get("page", 0))
+    except ValueError:
+        page = -1
+    pages = max(1, -(-len(manifest.leaves) // BLOCKS_PAGE))
+    if not 0 <= page < pages:
+        server_socket.sendto(b"ERROR: Invalid page", client_addr)
+        return
+    leaves = manifest.leaves[page * BLOCKS_PAGE:(page + 1) * BLOCKS_PAGE]
+    header = (f"BLOCKS {manifest.size} {manifest.mtime} {manifest.block_size} {len(manifest.leaves)} "
+              f"{manifest.root.hex()} {page} {pages}\n")
+    server_socket.sendto((header + "\n".join(leaf.hex() for leaf in leaves)).encode(), client_addr)
+
+def parse_ranges(text, file_size):
+    """Parse "start-end,start-end" byte ranges, clamped to the file size."""
+    ranges = []
+    for item in text.split(","):
+        start, end = (int(x) for x in item.split("-"))
+        start, end = max(0, start), min(end, file_size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+class ChunkPlan:
+    """
+    Byte ranges cut into chunk_size chunks, indexed by sequence number: plan[seq] is the
+    (offset, length) of the chunk, computed on demand so memory stays O(ranges), not O(chunks).
+    """
+    def __init__(self, ranges, chunk_size):
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.first_seqs = []  # sequence number of the first chunk of each range
+        self.total = 0
+        for start, end in ranges:
+            self.first_seqs.append(self.total)
+            self.total += -(-(end - start) // chunk_size)
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, seq):
+        if not 0 <= seq < self.total:
+            raise IndexError(seq)
+        i = bisect.bisect_right(self.first_seqs, seq) - 1
+        start, end = self.ranges[i]
+        offset = start + (seq - self.first_seqs[i]) * self.chunk_size
+        return offset, min(self.chunk_size, end - offset)
+
+def handle_list(server_socket, client_addr, args):
+    """
+    Send the list of available files to the client.
+    LIST page=<n> [prefix=<prefix>] [etag=<etag>] answers with one page datagram
+    "LIST <page> <pages> <etag>\n<lines>", or "NOT_MODIFIED <etag>" when the client's cached
+    etag is still current. Without page= the whole listing is sent in one datagram
+    (LIST [prefix=<prefix>] [offset=<n>] [limit=<n>]), or an ERROR when it doesn't fit in one.
+    """
+    options = parse_options(args)
+    if "page" not in options:
+        offset = int(options.get("offset", 0))
+        limit = int(options["limit"]) if "limit" in options else None
+        if offset < 0 or (limit is not None and limit < 0):
+            listing = b"ERROR: negative offset or limit"
+        else:
+            listing = file_index.list_files(options.get("prefix", ""), offset, limit)
+        if len(listing) > MAX_DATAGRAM:
+            listing = b"ERROR: listing too large, use LIST page=<n>"
+        server_socket.sendto(listing, client_addr)
+        return
+
+    page = int(options["page"])
+    if options.get("etag") and options["etag"] == file_index.etag:
+        server_socket.sendto(f"NOT_MODIFIED {file_index.etag}".encode(), client_addr)
+        return
+    try:
+        data, pages, etag = file_index.list_page(page, options.get("prefix", ""))
+    except ValueError as e:
+        server_socket.sendto(f"ERROR: {e}".encode(), client_addr)
+        return
+    server_socket.sendto(f"LIST {page} {pages} {etag}\n".encode() + data, client_addr)
+
+def handle_download(server_socket, client_addr, session_id, inbox, controller, filename, corruption_rate, ranges=None,
+                    fec=0.0, chunk_size=CHUNK_SIZE, codec=None, share=None, probed=0):
+    """
+    Handle file download request from the client (runs in the session's own thread).
+    The dispatcher puts the client's ACKs (parsed) and DONE datagrams for this session in inbox.
+    controller (a CongestionController) sizes the window of chunks in flight and paces them.
+    ranges ("start-end,...") restricts the transfer to the byte ranges a resuming client is missing.
+    fec > 0 adds a parity packet for every group of about 1/fec chunks (see send_chunks).
+    chunk_size is the one negotiated by the client (DOWNLOAD ... chunk=<n>).
+    codec (DOWNLOAD ... compress=<codec>) compresses the chunks that are worth it.
+    share is the client's ClientShare when the fair-share scheduler paces the transfers.
+    probed (DOWNLOAD ... probed=<n>) is the datagram size the client validated with PROBE.
+    """
+    try:
+        file = file_cache.acquire(filename, file_index.lookup(filename))
+    except OSError:
+        server_socket.sendto(b"ERROR: File not found", client_addr)
+        return
+
+    try:
+        file_size = file.size
+        chunks = ChunkPlan(parse_ranges(ranges, file_size) if ranges else [(0, file_size)], chunk_size)
+        print(f"[+] Starting download of {filename} for {client_addr} (session {session_id}), Size: {file_size} bytes, "
+              f"Chunks: {len(chunks)} of {chunk_size} bytes")
+        # Chunks and their retransmissions are sent straight from the shared read-only mapping,
+        # nothing is read into memory. A file being served must be replaced (os.replace), not
+        # truncated in place.
+        send_chunks(server_socket, client_addr, session_id, inbox, controller, filename, chunks, file.mapping,
+                    corruption_rate, fec, codec, file.mtime, share, probed)
+    finally:
+        file_cache.release(file)
+
+def send_chunks(server_socket, client_addr, session_id, inbox, controller, filename, chunks, mapping, corruption_rate,
+                fec=0.0, codec=None, mtime=0, share=None, probed=0):
+    """
+    Send the chunks of a transfer from the file mapping with selective repeat, then END.
+    State is O(window): chunks in flight, their timers and the ACKs above the ack floor.
+    With fec, every group of consecutive new chunks is followed by their XOR parity, from
+    which the client rebuilds one lost chunk of the group without a retransmission. The group
+    size starts at 1/fec and adapts to the loss left over: halved (down to FEC_MIN_GROUP) when
+    chunks still have to be retransmitted, grown by one after a group without any.
+    Chunks too large for a 1500-byte MTU are lost whole when one of their fragments is: when the
+    session's loss rate says so, the session ends with RESIZE <session> <smaller chunk size> and
+    the client requests what it is still missing again, cut into smaller chunks. probed is the
+    largest datagram the client's PROBE saw arrive whole (DOWNLOAD ... probed=<n>): chunks that
+    fit in it are not fragmented, their losses are congestion, left to the controller.
+    With codec, chunks that compress are sent compressed (flags = codec id), from the compression
+    cache shared with the other sessions (keyed by mtime, the file's version); parity is always
+    computed over the raw chunks.
+    With share, new chunks also wait for the fair-share scheduler: SCHEDULER_QUANTUM bytes are
+    asked for at a time and the grant arrives in inbox; retransmissions and parity go out at
+    once and are paid for by the next grant.
+    """
+    total_chunks = len(chunks)
+    ack_floor = 0        # every chunk below is acknowledged
+    acked_above = set()  # chunks acknowledged (by SACK) above ack_floor
+    inflight = {}        # seq -> (time sent, times retransmitted) of chunks waiting for their ACK
+    timers = []          # heap of (deadline, seq); stale entries are skipped
+    rtt = RttEstimator()
+    next_seq = 0         # next chunk never sent yet
+    next_send = 0.0      # earliest time of the next new chunk when the controller paces
+    retransmissions = 0
+    last_ack = time.monotonic()
+    client_done = False
+    max_group = min(0xFFFF, max(FEC_MIN_GROUP, round(1 / fec))) if fec else 0
+    group_size = max_group
+    group_start = 0      # first chunk of the parity group being sent
+    group_losses = 0     # retransmissions since the last parity packet
+    parity_sent = 0
+    credit = 0           # bytes granted by the scheduler not sent yet (negative: owed)
+    ticket = None        # scheduler request waiting for its grant
+
+    def send_packet(seq_num, offset, payload, packet_type=PACKET_DATA, flags=0):
+        nonlocal credit
+        header = build_data_header(session_id, seq_num, offset, payload, packet_type, flags)
+        credit -= len(header) + len(payload)
+        metrics.inc("datagrams_sent_total")
+        metrics.inc("bytes_sent_total", len(header) + len(payload))
+        if corruption_rate and random.random() < corruption_rate:
+            # Only the packets the simulation damages are copied
+            server_socket.sendto(corrupt_packet(header + payload, 1), client_addr)
+        else:
+            send_datagram(server_socket, client_addr, [header, payload])
+
+    def send_chunk(seq_num, attempt=0):
+        """Send (or resend, attempt > 0) a chunk from the mapping and arm its retransmission timer."""
+        offset, length = chunks[seq_num]
+        with memoryview(mapping)[offset:offset + length] as payload:
+            compressed = None
+            if codec:
+                compressed = compression_cache.get((filename, mtime, offset, length, codec), payload, CODECS[codec])
+            if compressed is None:
+                send_packet(seq_num, offset, payload)
+            else:
+                send_packet(seq_num, offset, compressed, flags=CODECS[codec].id)
+        now = time.monotonic()
+        inflight[seq_num] = (now, attempt)
+        heapq.heappush(timers, (now + rtt.timeout(attempt), seq_num))
+
+    def handle_ack(cumulative, sack_ranges):
+        """Acknowledge in bulk every chunk covered by a cumulative ACK + SACK ranges."""
+        nonlocal ack_floor, last_ack, timers
+        last_ack = time.monotonic()
+        newly_acked = []
+        for seq in range(ack_floor, min(cumulative, next_seq)):
+            acked_above.discard(seq)
+            if seq in inflight:
+                newly_acked.append((seq, *inflight.pop(seq)))
+        ack_floor = max(ack_floor, min(cumulative, next_seq))
+        for first, end in sack_ranges:
+            first, end = max(first, ack_floor), min(end, next_seq)
+            # Only chunks still in flight matter: walk whichever of the two is shorter
+            if end - first <= len(inflight):
+                candidates = range(first, end)
+            else:
+                candidates = [seq for seq in inflight if first <= seq < end]
+            for seq in candidates:
+                if seq in inflight:
+                    newly_acked.append((seq, *inflight.pop(seq)))
+                    acked_above.add(seq)
+        while ack_floor in acked_above:
+            acked_above.remove(ack_floor)
+            ack_floor += 1
+
+        # One RTT sample per ACK, from the latest chunk it covers that was sent only once (Karn's rule)
+        newest = max((sent_at for _, sent_at, attempt in newly_acked if not attempt), default=None)
+        sample = last_ack - newest if newest is not None else None
+        if sample is not None:
+            first_sample = rtt.srtt is None
+            rtt.sample(sample)
+            if first_sample:
+                # Chunks sent so far were armed with INITIAL_RTO, re-arm them with the real one
+                timers = [(sent + rtt.timeout(attempt), seq) for seq, (sent, attempt) in inflight.items()]
+                heapq.heapify(timers)
+        for seq, sent_at, attempt in newly_acked:
+            controller.on_ack(chunks[seq][1], sent_at, sample if not attempt and sent_at == newest else None, last_ack)
+
+    def send_parity():
+        """Close the current parity group: send its parity and size the next group."""
+        nonlocal group_start, group_size, group_losses, parity_sent
+        count = next_seq - group_start
+        send_packet(group_start, 0, xor_parity(mapping, chunks, group_start, count), PACKET_PARITY, count)
+        parity_sent += 1
+        metrics.inc("parity_sent_total")
+        if group_losses:
+            group_size = max(FEC_MIN_GROUP, group_size // 2)
+        else:
+            group_size = min(max_group, group_size + 1)
+        group_start, group_losses = next_seq, 0
+
+    def handle_message(message):
+        """Process one inbox item: a parsed (cumulative, SACK ranges) ACK or a DONE datagram (or a scheduler grant)."""
+        nonlocal client_done
+        if isinstance(message, tuple):
+            handle_ack(*message)
+        elif message.startswith(b"DONE"):
+            client_done = True
+
+    # Event-driven sender: fill the congestion window (at the pacing rate, if any), then sleep
+    # until an ACK arrives, the next paced send is due or the earliest retransmission timer
+    # expires (selective repeat, only expired chunks are resent)
+    while ack_floor < total_chunks and not client_done:
+        now = time.monotonic()
+        while next_seq < total_chunks and len(inflight) < controller.window() and now + PACING_QUANTUM >= next_send:
+            if share is not None and credit <= 0:
+                if ticket is None:
+                    ticket = scheduler.request(share, SCHEDULER_QUANTUM, lambda: inbox.put(b"GRANT"))
+                if not ticket.granted:
+                    break
+                credit += ticket.size
+                ticket = None
+            send_chunk(next_seq)
+            if controller.pacing_rate:
+                next_send = max(next_send, now) + chunks[next_seq][1] / controller.pacing_rate
+            next_seq += 1
+            if fec and (next_seq - group_start >= group_size or next_seq == total_chunks):
+                send_parity()
+
+        if now - last_ack >= SESSION_TIMEOUT and inflight:
+            print(f"[-] Session {session_id} timed out, dropping it")
+            metrics.inc("session_timeouts_total")
+            return
+        timeout = max(0, timers[0][0] - now) if timers else SESSION_TIMEOUT
+        if next_seq < total_chunks and len(inflight) < controller.window() and ticket is None:
+            timeout = min(timeout, max(0, next_send - PACING_QUANTUM - now))
+        try:
+            handle_message(inbox.get(timeout=min(timeout, SESSION_TIMEOUT)))
+            while True:
+                handle_message(inbox.get_nowait())  # process ACKs in bulk
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        expired = []
+        while timers and timers[0][0] <= now:
+            _, seq = heapq.heappop(timers)
+            if seq in inflight:  # timers of acknowledged chunks are just dropped
+                expired.append(seq)
+        for seq in expired:
+            sent_at, attempt = inflight[seq]
+            controller.on_loss(sent_at, now)
+            retransmissions += 1
+            group_losses += 1
+            metrics.inc("retransmissions_total")
+            if verbosity:
+                print(f"[-] Resending chunk {seq} (session {session_id}, rto {rtt.timeout(attempt + 1):.3f}s)")
+            send_chunk(seq, attempt + 1)
+
+        if (expired and chunks.chunk_size > max(SAFE_CHUNK_SIZE, probed - DATA_HEADER.size)
+                and next_seq >= RESIZE_MIN_CHUNKS and controller.loss_rate() - corruption_rate >= RESIZE_LOSS):
+            chunk_size = max(SAFE_CHUNK_SIZE, chunks.chunk_size // 2)
+            print(f"[-] Session {session_id} loses {controller.loss_rate():.0%} of its chunks, "
+                  f"resizing them from {chunks.chunk_size} to {chunk_size} bytes")
+            for _ in range(RESIZE_COPIES):
+                server_socket.sendto(f"RESIZE {session_id} {chunk_size}".encode(), client_addr)
+            metrics.inc("resizes_total")
+            return
+
+    # Wait for the client to confirm, it sends DONE once it has every chunk
+    deadline = time.monotonic() + DONE_TIMEOUT
+    while not client_done and time.monotonic() < deadline:
+        try:
+            handle_message(inbox.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    if client_done:
+        print(f"[+] Client finished receiving {filename} (session {session_id}).")
+    srtt = f"{rtt.srtt * 1000:.1f}ms" if rtt.srtt is not None else "n/a"
+    stats = controller.stats()
+    print(f"[+] Session {session_id}: {total_chunks} chunks, {retransmissions} retransmitted, srtt {srtt}, "
+          f"{stats['cc']} cwnd {stats['cwnd']}, pacing {stats['pacing_rate']} B/s, loss {stats['loss_rate']:.2%}"
+          + (f", {parity_sent} parity (group {group_size})" if fec else ""))
     
     # Signal the end of the transfer
-    server_socket.sendto(b"END", client_addr)  
+    server_socket.sendto(f"END {session_id}".encode(), client_addr)  
 
-def handle_client(server_socket, data, client_addr, corruption_rate):
-    """Handle incoming client requests."""
+def start_session(server_socket, client_addr, session_id, filename, corruption_rate, ranges, cc, fec,
+                  chunk_size=CHUNK_SIZE, max_window=MAX_WINDOW, codec=None, probed=0):
+    """Register a new transfer session and run it in its own thread."""
+    key = (client_addr, session_id)
+    with sessions_lock:
+        if key in sessions:
+            return  # retransmitted DOWNLOAD request, the session already runs
+        session = sessions[key] = Session(queue.Queue(), make_controller(cc, chunk_size, max_window))
+
+    def run():
+        start = time.monotonic()
+        metrics.inc("sessions_total")
+        share = scheduler.open(client_addr[0]) if scheduler.enabled else None
+        try:
+            handle_download(server_socket, client_addr, session_id, session.inbox, session.controller,
+                            filename, corruption_rate, ranges, fec, chunk_size, codec, share, probed)
+        except Exception as e:
+            metrics.inc("session_failures_total")
+            print(f"[-] Session {session_id} failed: {e}")
+        finally:
+            with sessions_lock:
+                sessions.pop(key, None)
+            if share is not None:
+                scheduler.close(share)
+            metrics.observe("transfer_seconds", time.monotonic() - start)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def dispatch_to_session(client_addr, session_id, data):
+    """Route a datagram to the inbox of its session, dropped if the session is unknown."""
+    with sessions_lock:
+        session = sessions.get((client_addr, session_id))
+    if session is not None:
+        session.inbox.put(data)
+
+def handle_compress(server_socket, client_addr, args):
+    """
+    Answer COMPRESS <codec>,<codec>,... (the client's codecs, preferred first) with the first one
+    this server has: "COMPRESS <codec>", or "COMPRESS none". The client then adds compress=<codec>
+    to its DOWNLOAD requests.
+    """
+    offered = args[0].split(",") if args else []
+    codec = next((codec for codec in offered if codec in CODECS), "none")
+    server_socket.sendto(f"COMPRESS {codec}".encode(), client_addr)
+
+def render_metrics(fmt):
+    """STATS body: the metrics, plus the sessions in progress and the counters of the caches."""
+    stats = {**file_cache.stats(), **compression_cache.stats()}
+    gauges = {"file_cache_files": stats.pop("files"), "file_cache_bytes": stats.pop("bytes"),
+              "scheduled_clients": len(scheduler.clients)}
+    with sessions_lock:
+        gauges["active_sessions"] = len(sessions)
+    counters = {(key if key.startswith("compress_") else f"file_cache_{key}") + "_total": value
+                for key, value in stats.items()}
+    return metrics.render(fmt, counters, gauges)
+
+def handle_stats(server_socket, client_addr, args):
+    """
+    Send the metrics of this process (STATS [format=json|prometheus]): request, byte, session,
+    retransmission and cache counters and latency histograms. With --workers, only those of the
+    worker that receives the request.
+    """
+    fmt = parse_options(args).get("format", "json")
+    if fmt not in METRICS_FORMATS:
+        server_socket.sendto(f"ERROR: Unknown format {fmt}".encode(), client_addr)
+        return
+    body = render_metrics(fmt).encode()
+    if len(body) > MAX_DATAGRAM:
+        server_socket.sendto(b"ERROR: Metrics too large for a datagram", client_addr)
+        return
+    server_socket.sendto(body, client_addr)
+
+def handle_cache(server_socket, client_addr):
+    """Send the counters of the file cache and the compression cache."""
+    stats = {**file_cache.stats(), **compression_cache.stats()}
+    server_socket.sendto(" ".join(f"{key}={value}" for key, value in stats.items()).encode(), client_addr)
+
+def handle_sessions(server_socket, client_addr):
+    """Send one line per transfer in progress: address, session id and congestion controller state."""
+    with sessions_lock:
+        current = list(sessions.items())
+    lines = []
+    for (addr, session_id), session in current:
+        stats = session.controller.stats()
+        lines.append(f"{addr[0]}:{addr[1]} {session_id} " + " ".join(f"{k}={v}" for k, v in stats.items()))
+    server_socket.sendto("\n".join(lines).encode()[:LIST_PAGE_SIZE], client_addr)
+
+def handle_client(server_socket, data, client_addr, corruption_rate, cc="reno", fec=0.0, max_chunk=MAX_CHUNK_SIZE,
+                  max_window=MAX_WINDOW):
+    """
+    Handle incoming client requests.
+    Session traffic (binary ACK datagrams, DONE <filename> session=<session>) is routed to
+    the session's thread; everything else is answered right away.
+    """
+    if data[0] == PROTOCOL_VERSION:
+        session_id, cumulative, sack_ranges = parse_ack(data)
+        dispatch_to_session(client_addr, session_id, (cumulative, sack_ranges))
+        metrics.inc("acks_received_total")
+        return
+
+    start = time.monotonic()
     command, *args = data.decode().split()
+    name = command if command in COMMANDS else "other"
+    metrics.inc(f'requests_total{{command="{name}"}}')
+    options = parse_options(arg for arg in args if arg.startswith(("session=", "chunk=", "compress=", "probed=")))
+    args = [arg for arg in args if not arg.startswith(("session=", "chunk=", "compress=", "probed="))]
+    session_id = int(options.get("session", 0))
+
     if command == "LIST":
-        handle_list(server_socket, client_addr)
-        print("[!] Client requested FILE_LIST...")  
+        handle_list(server_socket, client_addr, args)
+        if not any(arg.startswith("page=") and arg != "page=0" for arg in args):
+            print("[!] Client requested FILE_LIST...")  
     elif command == "DOWNLOAD":
         filename = args[0]
-        handle_download(server_socket, client_addr, filename, corruption_rate)  
+        ranges = args[1] if len(args) > 1 else None
+        chunk_size = int(options.get("chunk", min(CHUNK_SIZE, max_chunk)))
+        if not MIN_CHUNK_SIZE <= chunk_size <= max_chunk:
+            server_socket.sendto(f"ERROR: Chunk size must be between {MIN_CHUNK_SIZE} and {max_chunk}".encode(),
+                                 client_addr)
+            return
+        codec = options.get("compress")
+        if codec is not None and codec not in CODECS:
+            server_socket.sendto(f"ERROR: Unknown codec {codec}".encode(), client_addr)
+            return
+        start_session(server_socket, client_addr, session_id, filename, corruption_rate, ranges, cc, fec, chunk_size,
+                      max_window, codec, int(options.get("probed", 0)))
+    elif command == "DONE":
+        dispatch_to_session(client_addr, session_id, data)
+    elif command == "STAT":
+        handle_stat(server_socket, client_addr, args[0])
+    elif command == "HASH":
+        threading.Thread(target=handle_hash, args=(server_socket, client_addr, args[0]), daemon=True).start()
+    elif command == "BLOCKS":
+        threading.Thread(target=handle_blocks, args=(server_socket, client_addr, args[0], args[1:]),
+                         daemon=True).start()
+    elif command == "SESSIONS":
+        handle_sessions(server_socket, client_addr)
+    elif command == "CACHE":
+        handle_cache(server_socket, client_addr)
     elif command == "GET_CHUNK_SIZE":
-        handle_get_chunk_size(server_socket, client_addr)
+        handle_get_chunk_size(server_socket, client_addr, args, max_chunk)
         print("[!] Client requested CHUNK_SIZE...")
+    elif command == "PROBE":
+        handle_probe(client_addr, args)
+    elif command == "COMPRESS":
+        handle_compress(server_socket, client_addr, args)
+    elif command == "STATS":
+        handle_stats(server_socket, client_addr, args)
+    # Time to answer, or to hand the request over to its thread (DOWNLOAD, HASH, BLOCKS)
+    metrics.observe(f'request_seconds{{command="{name}"}}', time.monotonic() - start)
+
+def serve(server_socket, corruption_rate, cc="reno", fec=0.0, max_chunk=MAX_CHUNK_SIZE, max_window=MAX_WINDOW):
+    """Receive every datagram on server_socket and dispatch it."""
+    while True:
+        data, client_addr = server_socket.recvfrom(2048) 
+        try:
+            handle_client(server_socket, data, client_addr, corruption_rate, cc, fec, max_chunk, max_window)
+        except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
+            metrics.inc("malformed_requests_total")
+            print(f"[-] Malformed request from {client_addr}: {e}")
+        except OSError as e:
+            # A reply that couldn't be sent (too large, unreachable client...) only fails this request
+            print(f"[-] Failed to answer {client_addr}: {e}")
+
+def worker_main(worker_id, server_host, server_port, conn, corruption_rate, cc, fec, max_chunk, max_window, cache_size,
+                verbose=0, rate_limit=0, client_rate=0, weights=None, bucket_state=None):
+    """
+    Worker process: mirror the parent's file index from conn and serve on a SO_REUSEPORT socket.
+    The kernel hashes each datagram's address 4-tuple to one of the sockets, so every packet of a
+    client socket (its requests, ACKs and DONE) lands on the worker holding its sessions.
+    bucket_state is the rate_limit token bucket shared with the other workers.
+    """
+    global verbosity
+    verbosity = verbose
+    scheduler.configure(rate_limit, client_rate, weights, bucket_state)
+    file_cache.max_bytes = cache_size
+    file_index.apply(conn.recv())
+    def follow_index():
+        while True:
+            try:
+                snapshot = conn.recv()
+            except (EOFError, OSError):
+                os._exit(0)  # Parent is gone
+            file_index.apply(snapshot)
+            file_cache.invalidate(snapshot)
+    threading.Thread(target=follow_index, daemon=True).start()
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((server_host, server_port))
+    print(f"[+] Worker {worker_id} (pid {os.getpid()}) listening")
+    try:
+        serve(server_socket, corruption_rate, cc, fec, max_chunk, max_window)
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(server_host, server_port, workers, corruption_rate, cc, fec, max_chunk, max_window, cache_size,
+                verbose=0, rate_limit=0, client_rate=0, weights=None):
+    """
+    Start workers sharing the port, and keep their file indexes in sync with this process's.
+    Each worker schedules its own sessions, drawing on one rate_limit token bucket kept in shared
+    memory; client_rate applies to the sessions of a client on each worker.
+    """
+    connections = []
+    processes = []
+    bucket_state = multiprocessing.Array("d", 2)  # tokens and last refill of the shared rate_limit bucket
+    for worker_id in range(workers):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=worker_main, daemon=True,
+                                          args=(worker_id, server_host, server_port, receiver, corruption_rate, cc, fec,
+                                                max_chunk, max_window, cache_size, verbose, rate_limit, client_rate,
+                                                weights, bucket_state))
+        process.start()
+        sender.send(file_index.snapshot())
+        connections.append(sender)
+        processes.append(process)
+
+    def broadcast(changed):
+        snapshot = file_index.snapshot(changed)
+        for conn in connections:
+            try:
+                conn.send(snapshot)
+            except OSError as e:
+                print(f"[-] Failed to update a worker's file index: {e}")
+
+    threading.Thread(target=file_index.watch, args=(INDEX_INTERVAL, broadcast), daemon=True).start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+
+def server_main(server_host, server_port, corruption_rate, compute_hashes=False, cc="reno", fec=0.0, workers=1,
+                max_chunk=MAX_CHUNK_SIZE, max_window=MAX_WINDOW, cache_size=FILE_CACHE_SIZE, verbose=0,
+                rate_limit=0, client_rate=0, weights=None):
+    """
+    Main server: serve from this process, or from workers processes sharing the port.
+    rate_limit and client_rate cap the chunks sent in total and to each client address (bytes/s,
+    0 = unlimited), shared among the clients in proportion to weights (address -> weight, default 1).
+    """
+    global verbosity
+    verbosity = verbose
+    scheduler.configure(rate_limit, client_rate, weights)
+    file_index.compute_hashes = compute_hashes
+    file_index.refresh()
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("[-] --workers needs SO_REUSEPORT, which this platform does not support")
 
-def server_main(server_host, server_port, corruption_rate):
-    """Main server loop to handle incoming connections."""
-    update_file_list()  
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  
-    server_socket.bind((server_host, server_port))  
     print(f"Server listening on {server_host}:{server_port}...")
-    
     if corruption_rate > 0:
         print(f"[!] Packet Corruption Simulation Enabled ({corruption_rate * 100}% corruption rate)")
+    print(f"[!] Congestion control: {cc}"
+          + (f", window of at most {max_window} chunks" if max_window != MAX_WINDOW else ""))
+    if fec:
+        print(f"[!] Forward error correction: at least {fec:.0%} parity")
+    if scheduler.enabled:
+        print(f"[!] Fair-share scheduling: {rate_limit or 'unlimited'} B/s in total, "
+              f"{client_rate or 'unlimited'} B/s per client")
 
-    while True:
-        try:
-            data, client_addr = server_socket.recvfrom(2048) 
-            # Start a new thread to handle the client request
-            handle_client(server_socket, data, client_addr, corruption_rate)
-        except socket.timeout:
-            print("Waiting for client...")
+    if workers > 1:
+        print(f"[!] {workers} worker processes sharing the port")
+        run_workers(server_host, server_port, workers, corruption_rate, cc, fec, max_chunk, max_window, cache_size,
+                    verbose, rate_limit, client_rate, weights)
+        return
+
+    file_cache.max_bytes = cache_size
+    threading.Thread(target=file_index.watch, args=(INDEX_INTERVAL, file_cache.invalidate), daemon=True).start()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  
+    server_socket.bind((server_host, server_port))  
+    serve(server_socket, corruption_rate, cc, fec, max_chunk, max_window)
 
 def validate_loss_rate(value):
     """Validate that the corruption rate is between 0 and 1."""
@@ -165,17 +981,91 @@ def validate_loss_rate(value):
     except ValueError:
         raise argparse.ArgumentTypeError(f"Invalid corruption rate value: {value}")
 
+def validate_fec_ratio(value):
+    """Validate that the FEC redundancy ratio is between 0 and 0.5 (one parity per two chunks)."""
+    try:
+        float_value = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid FEC ratio value: {value}")
+    if float_value < 0 or float_value > 0.5:
+        raise argparse.ArgumentTypeError(f"FEC ratio must be between 0 and 0.5, got {float_value}")
+    return float_value
+
+def validate_chunk_size(value):
+    """Validate that the chunk size is between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE bytes."""
+    try:
+        int_value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid chunk size: {value}")
+    if not MIN_CHUNK_SIZE <= int_value <= MAX_CHUNK_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"Chunk size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}, got {int_value}")
+    return int_value
+
+def validate_positive(value):
+    """Validate that a count (workers, window) is a positive integer."""
+    try:
+        int_value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid count: {value}")
+    if int_value < 1:
+        raise argparse.ArgumentTypeError(f"Count must be at least 1, got {int_value}")
+    return int_value
+
+def validate_rate(value):
+    """Validate a bandwidth cap in bytes/s: 0 (unlimited) or a positive integer."""
+    try:
+        int_value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid rate: {value}")
+    if int_value < 0:
+        raise argparse.ArgumentTypeError(f"Rate must be 0 (unlimited) or positive, got {int_value}")
+    return int_value
+
+def validate_weight(value):
+    """Validate a scheduler weight given as ADDRESS=WEIGHT, returns (address, weight)."""
+    address, _, weight = value.partition("=")
+    try:
+        float_weight = float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid weight, expected ADDRESS=WEIGHT: {value}")
+    if not address or float_weight <= 0:
+        raise argparse.ArgumentTypeError(f"Weight must be ADDRESS=WEIGHT with WEIGHT > 0, got {value}")
+    return address, float_weight
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="UDP Server")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Server IP address")
     parser.add_argument("--port", type=int, default=8000, help="Server port")
     parser.add_argument("--loss", type=validate_loss_rate, default=0.0,
                       help="Packet corruption rate (between 0 and 1)")
+    parser.add_argument("--hash", action="store_true", help="Keep a SHA-256 of every file in the index")
+    parser.add_argument("--cc", choices=CONGESTION_CONTROLLERS, default="reno",
+                      help="Congestion controller of the transfers: AIMD (reno) or paced bandwidth estimate (rate)")
+    parser.add_argument("--fec", type=validate_fec_ratio, default=0.0,
+                      help="Minimum XOR parity redundancy (between 0 and 0.5, 0 = off), raised under loss")
+    parser.add_argument("--workers", type=validate_positive, default=1,
+                      help="Number of processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--chunk-size", type=validate_chunk_size, default=MAX_CHUNK_SIZE,
+                      help="Largest chunk size (bytes) negotiated with the clients")
+    parser.add_argument("--max-window", type=validate_positive, default=MAX_WINDOW,
+                      help="Upper bound of the congestion window, in chunks")
+    parser.add_argument("--cache-size", type=int, default=FILE_CACHE_SIZE,
+                      help="Total size (bytes) of the file mappings kept for reuse, 0 disables the file cache")
+    parser.add_argument("--rate-limit", type=validate_rate, default=0,
+                      help="Total bandwidth of the chunks in bytes/s (0 = unlimited)")
+    parser.add_argument("--client-rate", type=validate_rate, default=0,
+                      help="Bandwidth cap of each client address in bytes/s (0 = unlimited)")
+    parser.add_argument("--weight", type=validate_weight, action="append", default=[], metavar="ADDRESS=WEIGHT",
+                      help="Share of the bandwidth of a client address relative to the others (default 1), repeatable")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Also log every retransmitted chunk")
     
     args = parser.parse_args()
 
     os.makedirs(FILE_DIR, exist_ok=True)  
     try:
-        server_main(args.host, args.port, args.loss)  
+        server_main(args.host, args.port, args.loss, args.hash, args.cc, args.fec, args.workers, args.chunk_size,
+                    args.max_window, args.cache_size, args.verbose, args.rate_limit, args.client_rate,
+                    dict(args.weight))
     except KeyboardInterrupt:
         print("\nServer exited.")
\ No newline at end of file
@@ -0,0 +1,344 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# Benchmark configuration
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {"tcp": os.path.join(ROOT, "TCP", "server", "server.py"),
+           "udp": os.path.join(ROOT, "UDP", "server", "server.py")}
+CLIENTS = {"tcp": os.path.join(ROOT, "TCP", "client", "client.py"),
+           "udp": os.path.join(ROOT, "UDP", "client", "client.py")}
+# Corpus name -> [(number of files, file size)], from many tiny files to a few multi-GB ones
+CORPORA = {
+    "tiny": [(1000, 1024)],
+    "small": [(200, 64 * 1024)],
+    "medium": [(16, 8 * 1024 * 1024)],
+    "mixed": [(500, 4 * 1024), (20, 1024 * 1024), (2, 64 * 1024 * 1024)],
+    "large": [(2, 2 * 1024 ** 3)],
+}
+WORK_DIR = os.path.join(tempfile.gettempdir(), "networking-bench")  # Corpora are kept here between runs
+GENERATE_BLOCK = 1024 * 1024   # Bytes of random data written at a time when generating a corpus
+SERVER_START_TIMEOUT = 10      # Seconds to wait for "Server listening"
+SERVER_STOP_TIMEOUT = 5        # Seconds between SIGINT and SIGKILL of a server
+RUN_TIMEOUT = 600              # Seconds a client run may take before it is killed
+# Client output (lines of concurrent downloads can run together, corpus filenames are matched exactly)
+STARTED = re.compile(r"Starting download for: (g\d+_\d+\.bin)")
+DOWNLOADED = re.compile(r"\[\+\] Downloaded (g\d+_\d+\.bin) successfully!")
+SESSION_SUMMARY = re.compile(r"\[\+\] Session \d+: \d+ chunks, (\d+) retransmitted")
+
+
+def git_commit():
+    """Commit the benchmarked tree is at (with +dirty for uncommitted changes), None outside a git checkout."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+dirty" if dirty else "")
+
+def corpus_files(name):
+    """[(filename, size)] of a corpus."""
+    files = []
+    for group, (count, size) in enumerate(CORPORA[name]):
+        files.extend((f"g{group}_{i:05d}.bin", size) for i in range(count))
+    return files
+
+def generate_corpus(name, work_dir):
+    """
+    Create (once) the server directory of a corpus: <work_dir>/<name>/server_files, random data.
+    Returns the corpus directory, the servers run from it.
+    """
+    corpus_dir = os.path.join(work_dir, name)
+    marker = os.path.join(corpus_dir, "corpus.json")
+    files = corpus_files(name)
+    try:
+        with open(marker, "r") as f:
+            if json.load(f) == files:
+                return corpus_dir
+    except (OSError, ValueError):
+        pass
+
+    print(f"[!] Generating corpus {name}: {len(files)} file(s), {sum(size for _, size in files) / 1e6:.1f} MB")
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    os.makedirs(os.path.join(corpus_dir, "server_files"))
+    for filename, size in files:
+        with open(os.path.join(corpus_dir, "server_files", filename), "wb") as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(GENERATE_BLOCK, remaining))
+                f.write(block)
+                remaining -= len(block)
+    with open(marker, "w") as f:
+        json.dump(files, f)
+    return corpus_dir
+
+def free_port():
+    """A port free for both TCP and UDP on loopback."""
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+            tcp.bind(("127.0.0.1", 0))
+            port = tcp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+                try:
+                    udp.bind(("127.0.0.1", port))
+                except OSError:
+                    continue
+            return port
+
+def tcp_retransmissions():
+    """Kernel-wide count of retransmitted TCP segments (Linux), None elsewhere."""
+    try:
+        with open("/proc/net/snmp", "r") as f:
+            lines = [line.split() for line in f if line.startswith("Tcp:")]
+        return int(lines[1][lines[0].index("RetransSegs")])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def reap(process):
+    """Wait for a child process, returns its (CPU seconds, peak RSS in KB)."""
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss  # bytes on macOS
+    return round(usage.ru_utime + usage.ru_stime, 3), peak_rss
+
+def percentile(values, fraction):
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def start_server(protocol, corpus_dir, port, loss, window, log_path):
+    """Start a server on loopback from corpus_dir and wait until it listens."""
+    command = [sys.executable, "-u", SERVERS[protocol], "--port", str(port)]
+    if protocol == "udp":
+        command += ["--loss", str(loss)]
+        if window:
+            command += ["--max-window", str(window)]
+    log = open(log_path, "w")
+    server = subprocess.Popen(command, cwd=corpus_dir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        with open(log_path, "r") as f:
+            if "Server listening" in f.read():
+                time.sleep(0.2)  # printed just before the socket is bound
+                return server
+        if server.poll() is not None:
+            break
+        time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f"{protocol} server did not start, see {log_path}")
+
+def stop_server(server):
+    """Interrupt a server like Ctrl+C would, returns its (CPU seconds, peak RSS in KB)."""
+    server.send_signal(signal.SIGINT)
+    killer = threading.Timer(SERVER_STOP_TIMEOUT, server.kill)
+    killer.start()
+    try:
+        return reap(server)
+    finally:
+        killer.cancel()
+
+def run_client(protocol, client_dir, port, concurrency, chunk_size, window, log_path, timeout):
+    """
+    Run a client with --once until it exits (killed after timeout).
+    Returns (wall time, {filename: seconds from its start to its completion}, CPU seconds, peak RSS in KB).
+    """
+    command = [sys.executable, "-u", CLIENTS[protocol], "--port", str(port), "--once", "--max-files", str(concurrency)]
+    if protocol == "udp" and chunk_size:
+        command += ["--chunk-size", str(chunk_size)]
+    if protocol == "tcp" and window:
+        command += ["--streams", str(window)]
+    started = {}
+    completed = {}
+    start = time.monotonic()
+    client = subprocess.Popen(command, cwd=client_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    killer = threading.Timer(timeout, client.kill)
+    killer.start()
+    with open(log_path, "w") as log:
+        for line in client.stdout:
+            log.write(line)
+            now = time.monotonic()
+            for match in STARTED.finditer(line):
+                started[match.group(1)] = now
+            for match in DOWNLOADED.finditer(line):
+                completed[match.group(1)] = now - started.get(match.group(1), start)
+    cpu, peak_rss = reap(client)
+    killer.cancel()
+    return time.monotonic() - start, completed, cpu, peak_rss
+
+def run_once(protocol, corpus, corpus_dir, run_dir, concurrency, chunk_size, window, loss, timeout):
+    """Benchmark one configuration, returns its result record."""
+    files = corpus_files(corpus)
+    client_dir = os.path.join(run_dir, "client")
+    shutil.rmtree(client_dir, ignore_errors=True)
+    os.makedirs(client_dir)
+    with open(os.path.join(client_dir, "input.txt"), "w") as f:
+        f.writelines(f"{filename}\n" for filename, _ in files)
+
+    port = free_port()
+    server_log = os.path.join(run_dir, "server.log")
+    server = start_server(protocol, corpus_dir, port, loss, window, server_log)
+    retrans_before = tcp_retransmissions() if protocol == "tcp" else None
+    try:
+        wall, completed, client_cpu, client_rss = run_client(protocol, client_dir, port, concurrency, chunk_size,
+                                                              window, os.path.join(run_dir, "client.log"), timeout)
+    finally:
+        server_cpu, server_rss = stop_server(server)
+
+    if protocol == "udp":
+        with open(server_log, "r", errors="replace") as f:
+            # From the per-session summaries: the server logs each resent chunk only with -v
+            retransmissions = sum(int(m.group(1)) for m in map(SESSION_SUMMARY.search, f) if m)
+    else:
+        retrans_after = tcp_retransmissions()
+        retransmissions = (retrans_after - retrans_before
+                           if retrans_before is not None and retrans_after is not None else None)
+
+    # A file counts only if it was reported and has the right size
+    sizes = dict(files)
+    downloads = os.path.join(client_dir, "downloads")
+    complete = [name for name in completed
+                if name in sizes and os.path.exists(os.path.join(downloads, name))
+                and os.path.getsize(os.path.join(downloads, name)) == sizes[name]]
+    total_bytes = sum(sizes[name] for name in complete)
+    latencies = [completed[name] for name in complete]
+    shutil.rmtree(client_dir, ignore_errors=True)  # multi-GB corpora
+    return {
+        "protocol": protocol,
+        "corpus": corpus,
+        "concurrency": concurrency,
+        "chunk_size": chunk_size if protocol == "udp" else None,
+        "window": window or None,
+        "loss": loss,
+        "files": len(files),
+        "files_completed": len(complete),
+        "bytes": total_bytes,
+        "wall_time": round(wall, 3),
+        "throughput_mbps": round(total_bytes / 1e6 / max(wall, 1e-6), 2),
+        "latency_p50": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "latency_p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+        "client_cpu": client_cpu,
+        "server_cpu": server_cpu,
+        "client_peak_rss_kb": client_rss,
+        "server_peak_rss_kb": server_rss,
+        "retransmissions": retransmissions,
+    }
+
+def configurations(args):
+    """Every (protocol, corpus, concurrency, chunk size, window, loss) to run; TCP has no --loss or chunk size."""
+    seen = set()
+    for protocol, corpus, concurrency, chunk_size, window, loss in itertools.product(
+            args.protocols, args.corpora, args.concurrency, args.chunk_sizes, args.windows, args.loss):
+        if protocol == "tcp":
+            if loss:
+                continue
+            chunk_size = 0
+        config = (protocol, corpus, concurrency, chunk_size, window, loss)
+        if config not in seen:
+            seen.add(config)
+            yield config
+
+def cell(value, spec):
+    """Format a table cell, "-" (right-aligned to the same width) for a missing value."""
+    if value is None:
+        return "-".rjust(int(re.match(r">(\d+)", spec).group(1)))
+    return format(value, spec)
+
+def run_key(run):
+    return (run["protocol"], run["corpus"], run["concurrency"], run["chunk_size"], run["window"], run["loss"])
+
+def print_runs(runs, baseline=None):
+    """Print a results table; with a baseline, the throughput change of every matching configuration."""
+    previous = {}
+    for run in (baseline or {}).get("runs", []):
+        previous.setdefault(run_key(run), []).append(run["throughput_mbps"])
+    print(f"\n{'proto':<5} {'corpus':<7} {'conc':>4} {'chunk':>6} {'window':>6} {'loss':>5} {'done':>9} "
+          f"{'MB/s':>8} {'p50 s':>7} {'p99 s':>7} {'cpu s':>7} {'rss MB':>7} {'retx':>6}  {'vs base':>7}")
+    for run in runs:
+        change = ""
+        if previous.get(run_key(run)):
+            base = sum(previous[run_key(run)]) / len(previous[run_key(run)])
+            change = f"{(run['throughput_mbps'] / base - 1) * 100:+.1f}%" if base else ""
+        files = f"{run['files_completed']}/{run['files']}"
+        rss_mb = (run['client_peak_rss_kb'] + run['server_peak_rss_kb']) / 1024
+        print(f"{run['protocol']:<5} {run['corpus']:<7} {run['concurrency']:>4} "
+              f"{cell(run['chunk_size'] or None, '>6')} {cell(run['window'], '>6')} {run['loss']:>5} {files:>9} "
+              f"{run['throughput_mbps']:>8.1f} {cell(run['latency_p50'], '>7.3f')} {cell(run['latency_p99'], '>7.3f')} "
+              f"{run['client_cpu'] + run['server_cpu']:>7.2f} {rss_mb:>7.1f} "
+              f"{cell(run['retransmissions'], '>6')}  {change:>7}")
+
+def bench_main(args):
+    """Run every configuration args.repeat times and write the results to args.output as JSON."""
+    os.makedirs(args.work_dir, exist_ok=True)
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "runs": [],
+    }
+    corpus_dirs = {corpus: generate_corpus(corpus, args.work_dir) for corpus in args.corpora}
+    run_dir = os.path.join(args.work_dir, "run")
+    os.makedirs(run_dir, exist_ok=True)
+    for protocol, corpus, concurrency, chunk_size, window, loss in configurations(args):
+        for repeat in range(args.repeat):
+            print(f"[!] {protocol} {corpus}: concurrency {concurrency}, chunk {chunk_size or 'default'}, "
+                  f"window {window or 'default'}, loss {loss} (run {repeat + 1}/{args.repeat})")
+            run = run_once(protocol, corpus, corpus_dirs[corpus], run_dir, concurrency, chunk_size, window, loss,
+                           args.timeout)
+            run["repeat"] = repeat
+            results["runs"].append(run)
+            if run["files_completed"] < run["files"]:
+                print(f"[-] Only {run['files_completed']}/{run['files']} file(s) completed, logs in {run_dir}")
+
+    output = args.output or f"bench-{(commit or 'nogit')[:12]}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        print(f"[!] Baseline: {args.compare} (commit {baseline.get('commit')})")
+    print_runs(results["runs"], baseline)
+    print(f"\n[+] Results written to {output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the TCP and UDP transfer engines")
+    parser.add_argument("--protocols", nargs="+", choices=sorted(SERVERS), default=["tcp", "udp"])
+    parser.add_argument("--corpora", nargs="+", choices=list(CORPORA), default=["tiny", "medium"],
+                        help="File sets to transfer (generated once in --work-dir)")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[4], help="Client --max-files values")
+    parser.add_argument("--chunk-sizes", nargs="+", type=int, default=[0],
+                        help="UDP client --chunk-size values (0 = negotiated from the path MTU probe)")
+    parser.add_argument("--windows", nargs="+", type=int, default=[0],
+                        help="UDP server --max-window / TCP client --streams values (0 = default)")
+    parser.add_argument("--loss", nargs="+", type=float, default=[0.0],
+                        help="UDP server --loss values (TCP runs only use 0)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every configuration")
+    parser.add_argument("--timeout", type=int, default=RUN_TIMEOUT, help="Seconds before a client run is killed")
+    parser.add_argument("--work-dir", default=WORK_DIR, help="Where corpora are generated and runs happen")
+    parser.add_argument("--output", help="JSON results file (default: bench-<commit>.json)")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare throughput with")
+    args = parser.parse_args()
+    try:
+        bench_main(args)
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted.")
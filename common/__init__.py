@@ -0,0 +1 @@
+"""Code shared by the TCP and UDP servers and clients, which put the project root on sys.path to import it."""
@@ -0,0 +1,68 @@
+"""Compression of the file blocks the servers send, and the cache of the compressed blocks."""
+import threading
+import zlib
+from collections import OrderedDict
+
+COMPRESS_SAMPLE = 4096    # Bytes of a block compressed first to tell whether it is worth it
+COMPRESS_MAX_RATIO = 0.9  # Blocks that don't shrink below this ratio are sent raw
+COMPRESS_CACHE_SIZE = 64 * 1024 * 1024  # Compressed blocks kept for the next clients
+COMPRESS_ENTRY_SIZE = 128  # Bookkeeping bytes counted per cached block
+
+def compress_block(data, codec):
+    """
+    Compress data with codec, None when it isn't worth it: a COMPRESS_SAMPLE-byte sample that
+    zlib can't shrink below COMPRESS_MAX_RATIO (already compressed or random data) skips the
+    block without compressing all of it.
+    """
+    if (len(data) > COMPRESS_SAMPLE
+            and len(zlib.compress(data[:COMPRESS_SAMPLE], 1)) > COMPRESS_SAMPLE * COMPRESS_MAX_RATIO):
+        return None
+    compressed = codec.compress(data)
+    return compressed if len(compressed) < len(data) * COMPRESS_MAX_RATIO else None
+
+class CompressionCache:
+    """
+    Process-wide LRU of compressed file blocks keyed by (name, mtime, offset, length, codec),
+    so a hot file is compressed once rather than once per client. Blocks that don't compress
+    are remembered too (as None, sent raw). Stale versions of a file just age out.
+    """
+    def __init__(self, max_bytes=COMPRESS_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()  # key -> compressed bytes or None, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0     # blocks sent raw
+        self.raw_bytes = 0   # bytes of the blocks served
+        self.wire_bytes = 0  # ... and what was sent for them
+        self.lock = threading.Lock()
+
+    def get(self, key, data, codec):
+        """The compressed form of data, the block identified by key; None to send it raw."""
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                compressed = self.blocks[key]
+            else:
+                self.misses += 1
+                compressed = False
+        if compressed is False:
+            compressed = compress_block(data, codec)
+            with self.lock:
+                if self.max_bytes and key not in self.blocks:
+                    self.blocks[key] = compressed
+                    self.size += COMPRESS_ENTRY_SIZE + len(compressed or b"")
+                    while self.size > self.max_bytes:
+                        _, dropped = self.blocks.popitem(last=False)
+                        self.size -= COMPRESS_ENTRY_SIZE + len(dropped or b"")
+        with self.lock:
+            self.skipped += compressed is None
+            self.raw_bytes += len(data)
+            self.wire_bytes += len(compressed if compressed is not None else data)
+        return compressed
+
+    def stats(self):
+        with self.lock:
+            return {"compress_hits": self.hits, "compress_misses": self.misses, "compress_skipped": self.skipped,
+                    "compress_raw_bytes": self.raw_bytes, "compress_wire_bytes": self.wire_bytes}
@@ -0,0 +1,308 @@
+"""Catalog and open-file cache of the directory the servers share, and the block manifests' Merkle root."""
+import bisect
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+STAT_BATCH = 1000     # Known files re-stat'ed per refresh
+BLOCK_SIZE = 1024 * 1024  # Bytes per block of the BLOCKS hash manifest
+FILE_CACHE_SIZE = 1024 ** 3  # Total size of the files kept open (or mapped) by the file cache
+FILE_CACHE_FILES = 256       # Files kept open (or mapped) by the file cache
+
+FileEntry = namedtuple("FileEntry", ["size", "mtime"])
+# SHA-256 of every block of a file (leaves) and the root of the Merkle tree over them
+BlockManifest = namedtuple("BlockManifest", ["size", "mtime", "block_size", "leaves", "root"])
+
+def merkle_root(leaves):
+    """Root of the binary SHA-256 tree over leaves (an odd node is carried up as is)."""
+    level = list(leaves) or [hashlib.sha256(b"").digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+def paginate(listing, page_size):
+    """Cut a listing into (start, end) pages of at most page_size bytes, on line boundaries."""
+    pages = []
+    start = 0
+    while start < len(listing):
+        end = min(start + page_size, len(listing))
+        if end < len(listing):
+            cut = listing.rfind(b"\n", start, end) + 1
+            # A line longer than a page gets a page of its own
+            end = cut if cut > start else listing.find(b"\n", end) + 1 or len(listing)
+        pages.append((start, end))
+        start = end
+    return pages or [(0, 0)]
+
+class FileIndex:
+    """
+    In-memory catalog of a directory: filename -> FileEntry(size, mtime).
+    refresh() is incremental: the directory is only listed again when its own mtime changes
+    (files added, removed or renamed) and then only new names are stat'ed; existing entries
+    are re-stat'ed STAT_BATCH at a time, round robin, to pick up files rewritten in place.
+    The full LIST response is kept pre-serialized and rebuilt only when something changed,
+    with page_size, cut in pages of at most page_size bytes (list_page) under an etag.
+    """
+    def __init__(self, directory, compute_hashes=False, page_size=0):
+        self.directory = directory
+        self.compute_hashes = compute_hashes
+        self.page_size = page_size
+        self.entries = {}      # filename -> FileEntry
+        self.lines = {}        # filename -> serialized "name size\n" line
+        self.hashes = {}       # filename -> (size, mtime, sha256 hex)
+        self.blocks = {}       # filename -> BlockManifest
+        self.names = []        # sorted filenames, for prefix search and pagination
+        self.listing = b""     # serialized full listing
+        self.pages = [(0, 0)]  # (start, end) of every LIST page in listing
+        self.etag = ""         # digest of listing, identifies a catalog version
+        self.version = 0       # bumped on every change
+        self.dir_mtime = None
+        self.cursor = 0        # next entry to re-stat
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Bring the index up to date, returns the names of changed (or removed) files."""
+        changed = set()
+        dir_mtime = os.stat(self.directory).st_mtime_ns
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            present = set()
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name in self.entries:
+                        present.add(entry.name)
+                        continue
+                    if entry.is_file():
+                        st = entry.stat()
+                        self._set(entry.name, FileEntry(st.st_size, st.st_mtime_ns))
+                        present.add(entry.name)
+                        changed.add(entry.name)
+            for name in set(self.entries) - present:
+                self._remove(name)
+                changed.add(name)
+
+        # Re-stat a batch of known files
+        names = self.names[self.cursor:self.cursor + STAT_BATCH]
+        self.cursor = self.cursor + STAT_BATCH if self.cursor + STAT_BATCH < len(self.names) else 0
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                self._remove(name)
+                changed.add(name)
+                continue
+            entry = FileEntry(st.st_size, st.st_mtime_ns)
+            if self.entries.get(name) != entry:
+                self._set(name, entry)
+                changed.add(name)
+
+        if changed:
+            self._rebuild()
+            if self.compute_hashes:
+                for name in changed:
+                    if name in self.entries:
+                        self.block_manifest(name)
+        return changed
+
+    def _set(self, name, entry):
+        self.entries[name] = entry
+        self.lines[name] = f"{name} {entry.size}\n".encode()
+
+    def _remove(self, name):
+        self.entries.pop(name, None)
+        self.lines.pop(name, None)
+        self.hashes.pop(name, None)
+        self.blocks.pop(name, None)
+
+    def _rebuild(self):
+        names = sorted(self.entries)
+        listing = b"".join(self.lines[name] for name in names)
+        pages = paginate(listing, self.page_size) if self.page_size else [(0, len(listing))]
+        etag = hashlib.sha1(listing).hexdigest()[:16]
+        with self.lock:
+            self.names = names
+            self.listing = listing
+            self.pages = pages
+            self.etag = etag
+            self.version += 1
+
+    def snapshot(self, names=None):
+        """
+        Entries, cached hashes and block manifests of names (every file by default), None for
+        removed names: what a worker process needs to apply() to mirror this index.
+        """
+        names = self.entries if names is None else names
+        return {name: (self.entries[name], self.hashes.get(name), self.blocks.get(name))
+                if name in self.entries else None for name in names}
+
+    def apply(self, snapshot):
+        """Install a snapshot() taken from the index of another process."""
+        for name, item in snapshot.items():
+            if item is None:
+                self._remove(name)
+                continue
+            entry, cached, manifest = item
+            self._set(name, entry)
+            if cached:
+                self.hashes[name] = cached
+            if manifest:
+                self.blocks[name] = manifest
+        if snapshot:
+            self._rebuild()
+
+    def watch(self, interval, on_change=None):
+        """Refresh forever, every interval seconds, passing changed names to on_change."""
+        while True:
+            try:
+                changed = self.refresh()
+                if changed and on_change:
+                    on_change(changed)
+            except OSError as e:
+                print(f"[-] Failed to refresh file index: {e}")
+            time.sleep(interval)
+
+    def lookup(self, name):
+        return self.entries.get(name)
+
+    def list_files(self, prefix="", offset=0, limit=None):
+        """Serialized listing of the files starting with prefix, paginated by offset/limit."""
+        with self.lock:
+            names, listing = self.names, self.listing
+        if not prefix and not offset and limit is None:
+            return listing
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + "\U0010ffff") if prefix else len(names)
+        start += offset
+        if limit is not None:
+            end = min(end, start + limit)
+        lines = self.lines
+        return b"".join(lines.get(name, b"") for name in names[start:end])
+
+    def list_page(self, page, prefix=""):
+        """Return (page bytes, page count, etag) of the listing, optionally filtered by prefix."""
+        with self.lock:
+            listing, pages, etag = self.listing, self.pages, self.etag
+        if prefix:
+            listing = self.list_files(prefix)
+            pages = paginate(listing, self.page_size) if self.page_size else [(0, len(listing))]
+        if not 0 <= page < len(pages):
+            raise ValueError(f"no page {page}")
+        start, end = pages[page]
+        return listing[start:end], len(pages), etag
+
+    def file_hash(self, name):
+        """SHA-256 of a file, computed once per (size, mtime) and cached."""
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        cached = self.hashes.get(name)
+        if cached and cached[:2] == (entry.size, entry.mtime):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(os.path.join(self.directory, name), "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        self.hashes[name] = (entry.size, entry.mtime, digest.hexdigest())
+        return digest.hexdigest()
+
+    def block_manifest(self, name):
+        """
+        SHA-256 of every BLOCK_SIZE block of a file and their Merkle root, computed once per
+        (size, mtime) and cached. The same pass caches the whole-file hash.
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        cached = self.blocks.get(name)
+        if cached and (cached.size, cached.mtime) == entry:
+            return cached
+        digest = hashlib.sha256()
+        leaves = []
+        with open(os.path.join(self.directory, name), "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+                leaves.append(hashlib.sha256(block).digest())
+        manifest = BlockManifest(entry.size, entry.mtime, BLOCK_SIZE, leaves, merkle_root(leaves))
+        self.hashes[name] = (entry.size, entry.mtime, digest.hexdigest())
+        self.blocks[name] = manifest
+        return manifest
+
+class FileCache:
+    """
+    Process-wide LRU of opened files keyed by name + mtime, shared by every transfer thread:
+    all the transfers of a hot file send from one open file (TCP: a descriptor read with
+    sendfile or pread) or mapping (UDP) instead of opening it per transfer. opener(path) opens
+    one, as the server's CachedFile: size, mtime, refs, cached and close(). Bounded by the total
+    size held open (an open file pins its disk space even once deleted) and by the number of
+    files. Files that change in the index are invalidated; an evicted or invalidated file is
+    closed once the last transfer using it releases it.
+    """
+    def __init__(self, directory, opener, max_bytes=FILE_CACHE_SIZE, max_files=FILE_CACHE_FILES):
+        self.directory = directory
+        self.opener = opener
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.files = OrderedDict()  # name -> opened file, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, name, entry=None):
+        """
+        Open name, from the cache when the cached file matches entry (its FileEntry in the
+        index). Returns the opened file to release() at the end of the transfer; raises OSError.
+        """
+        with self.lock:
+            cached = self.files.get(name)
+            if cached is not None and (cached.size, cached.mtime) == entry:
+                self.files.move_to_end(name)
+                self.hits += 1
+                cached.refs += 1
+                return cached
+            self.misses += 1
+
+        opened = self.opener(os.path.join(self.directory, name))
+        with self.lock:
+            opened.refs += 1
+            if self.max_bytes and opened.size <= self.max_bytes and self.max_files:
+                self._drop(name)  # older version
+                self.files[name] = opened
+                opened.cached = True
+                self.size += opened.size
+                while self.size > self.max_bytes or len(self.files) > self.max_files:
+                    self._drop(next(iter(self.files)))
+                    self.evictions += 1
+        return opened
+
+    def release(self, cached):
+        with self.lock:
+            cached.refs -= 1
+            unused = cached.refs == 0 and not cached.cached
+        if unused:
+            cached.close()
+
+    def _drop(self, name):
+        """Take name out of the cache (lock held); closed now when unused, else by its last release()."""
+        cached = self.files.pop(name, None)
+        if cached is None:
+            return
+        self.size -= cached.size
+        cached.cached = False
+        if cached.refs == 0:
+            cached.close()
+
+    def invalidate(self, names):
+        """Forget the cached files of names, changed or removed in the index."""
+        with self.lock:
+            for name in names:
+                self._drop(name)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "files": len(self.files), "bytes": self.size}
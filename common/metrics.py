@@ -0,0 +1,103 @@
+"""Counters, gauges and latency histograms of the servers (STATS) and the clients (--metrics)."""
+import bisect
+import json
+import threading
+import time
+
+# Upper bounds (s) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+METRICS_FORMATS = ("json", "prometheus")
+
+class Histogram:
+    """Distribution of latencies over LATENCY_BUCKETS, plus an overflow bucket."""
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, None when it is the overflow bucket."""
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS + (None,), self.buckets):
+            seen += n
+            if n and seen >= q * self.count:
+                return bound
+        return 0.0
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of this process. An update is one dict operation
+    under a lock, cheap enough for the per-chunk paths. Names may carry Prometheus labels,
+    e.g. requests_total{command="LIST"}; prefix is prepended to every name in Prometheus output.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, name, delta):
+        """Move a gauge (sessions in progress...) by delta."""
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self, counters=None, gauges=None):
+        """Every value as a plain dict; counters and gauges are extra values kept elsewhere (caches)."""
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 3),
+                "counters": {**self.counters, **(counters or {})},
+                "gauges": {**self.gauges, **(gauges or {})},
+                "histograms": {name: {"count": h.count, "sum": round(h.sum, 6), "p50": h.quantile(0.5),
+                                      "p99": h.quantile(0.99), "buckets": list(h.buckets)}
+                               for name, h in self.histograms.items()},
+            }
+
+    def render(self, fmt="json", counters=None, gauges=None):
+        """snapshot() as JSON, or as Prometheus text exposition (fmt="prometheus")."""
+        snapshot = self.snapshot(counters, gauges)
+        if fmt != "prometheus":
+            return json.dumps(snapshot, sort_keys=True)
+        lines = [f"{self.prefix}uptime_seconds {snapshot['uptime_seconds']}"]
+        typed = set()
+
+        def declare(name, kind):
+            base = name.partition("{")[0]
+            if base not in typed:
+                typed.add(base)
+                lines.append(f"# TYPE {self.prefix}{base} {kind}")
+
+        for kind in ("counter", "gauge"):
+            for name, value in sorted(snapshot[kind + "s"].items()):
+                declare(name, kind)
+                lines.append(f"{self.prefix}{name} {value}")
+        for name, h in sorted(snapshot["histograms"].items()):
+            declare(name, "histogram")
+            base, _, labels = name.partition("{")
+            labels = labels.rstrip("}") + "," if labels else ""
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), h["buckets"]):
+                cumulative += n
+                lines.append(f'{self.prefix}{base}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.prefix}{base}_sum{suffix} {h['sum']}")
+            lines.append(f"{self.prefix}{base}_count{suffix} {h['count']}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,214 @@
+"""Token buckets limiting bandwidth, and the weighted fair queuing scheduler pacing the servers' file data."""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+SCHEDULER_QUANTUM = 64 * 1024  # Bytes of file data granted at a time by the fair-share scheduler
+SCHEDULER_BURST = 0.01   # Seconds of traffic a rate cap lets through at once
+
+class TokenBucket:
+    """
+    Bandwidth cap: tokens (bytes) accrue at rate bytes/s (0 = unlimited) up to burst, one second
+    of traffic by default, and are spent possibly into debt. The scheduler asks delay() and
+    charge()s its grants under its own lock; consume(n) is the clients' limiter, it sleeps as
+    long as needed to stay under rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(rate, 1) if burst is None else burst
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self, now):
+        """Seconds until the bucket is out of debt, 0 when a grant may go now (or rate is 0)."""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return max(0.0, -self.tokens / self.rate)
+
+    def charge(self, n):
+        if self.rate > 0:
+            self.tokens -= n
+
+    def consume(self, n):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.delay(time.monotonic())
+            self.charge(n)
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose tokens and last refill live in state, a multiprocessing.Array("d", 2)
+    shared by the --workers processes: they all draw on the one --rate-limit, so a single
+    transfer may use all of it. Zeroed state starts full.
+    """
+    def __init__(self, rate, burst, state):
+        self.rate = rate
+        self.burst = burst
+        self.state = state
+        self.lock = state.get_lock()  # reentrant, consume() holds it around delay() and charge()
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    def delay(self, now):
+        if self.rate <= 0:
+            return 0.0
+        with self.state.get_lock():
+            tokens, last = self.state
+            tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+            self.state[0] = tokens
+            self.state[1] = max(last, now)
+        return max(0.0, -tokens / self.rate)
+
+    def charge(self, n):
+        if self.rate > 0:
+            with self.state.get_lock():
+                self.state[0] -= n
+
+class ClientShare:
+    """Scheduler state of one client address: weight, own cap and tickets waiting in order."""
+    def __init__(self, address, weight, rate):
+        self.address = address
+        self.weight = weight
+        self.bucket = TokenBucket(rate, max(SCHEDULER_QUANTUM, rate * SCHEDULER_BURST))
+        self.finish = 0.0  # virtual finish time of the last ticket queued
+        self.queue = deque()
+        self.transfers = 0
+
+class Ticket:
+    """size bytes a transfer waits to send; wake() is called once they are granted."""
+    def __init__(self, share, size, wake):
+        self.share = share
+        self.size = size
+        self.wake = wake
+        self.tag = 0.0
+        self.queued = time.monotonic()
+        self.granted = False
+
+class FairScheduler:
+    """
+    Weighted fair queuing of the file data sent to the clients, paced by token buckets.
+    Transfers ask for the bytes they are about to send (SCHEDULER_QUANTUM at a time) and a
+    dispatcher thread grants them in order of virtual finish time, max(virtual time, client's
+    last tag) + size / weight, as fast as the global bucket (rate) allows: clients get shares
+    of the bandwidth in proportion to their weights however many connections they open, and a
+    small download starting next to bulk transfers goes out at once. A client over its own
+    cap (client_rate) is set aside until its bucket refills, without holding up the others.
+    Clients are told apart by address; rates are bytes/s, 0 = unlimited, both 0 = disabled.
+    With shared (a SharedTokenBucket's state), the global bucket is the one of every worker.
+    Grant waits are observed in metrics (pacing_wait_seconds), when given.
+    """
+    def __init__(self, rate=0, client_rate=0, weights=None, metrics=None):
+        self.cond = threading.Condition()
+        self.clients = {}
+        self.ready = []    # heap of (tag of the next ticket, seq, share): clients that may send
+        self.delayed = []  # heap of (time, seq, share): clients waiting for their own cap
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        self.dispatcher = None
+        self.metrics = metrics
+        self.configure(rate, client_rate, weights)
+
+    def configure(self, rate=0, client_rate=0, weights=None, shared=None):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.weights = dict(weights or {})
+        burst = max(SCHEDULER_QUANTUM, rate * SCHEDULER_BURST)
+        self.bucket = TokenBucket(rate, burst) if shared is None else SharedTokenBucket(rate, burst, shared)
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or self.client_rate > 0
+
+    def open(self, address):
+        """Register a transfer of the client at address, returns the client's share."""
+        with self.cond:
+            share = self.clients.get(address)
+            if share is None:
+                share = self.clients[address] = ClientShare(address, self.weights.get(address, 1.0), self.client_rate)
+            share.transfers += 1
+            return share
+
+    def close(self, share):
+        with self.cond:
+            share.transfers -= 1
+            if not share.transfers and not share.queue and self.clients.get(share.address) is share:
+                del self.clients[share.address]
+
+    def request(self, share, size, wake):
+        """Queue size bytes of a transfer of share's client; wake() is called once they may be sent."""
+        ticket = Ticket(share, size, wake)
+        with self.cond:
+            ticket.tag = share.finish = max(self.virtual_time, share.finish) + size / share.weight
+            share.queue.append(ticket)
+            if len(share.queue) == 1:
+                self._schedule(share, time.monotonic())
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+                self.dispatcher.start()
+            self.cond.notify()
+        return ticket
+
+    def acquire(self, share, size):
+        """Block until size bytes of share's transfer may be sent (threads engine)."""
+        granted = threading.Event()
+        self.request(share, size, granted.set)
+        granted.wait()
+
+    async def acquire_async(self, share, size):
+        """acquire for the asyncio engine: the dispatcher completes a future on the event loop."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        self.request(share, size, wake)
+        await granted
+
+    def _schedule(self, share, now):
+        """Put a client with tickets back in line: ready, or set aside until its cap allows."""
+        delay = share.bucket.delay(now)
+        if delay:
+            heapq.heappush(self.delayed, (now + delay, next(self.sequence), share))
+        else:
+            heapq.heappush(self.ready, (share.queue[0].tag, next(self.sequence), share))
+
+    def _dispatch(self):
+        """Grant tickets, smallest tag first, whenever the global bucket allows."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self._schedule(heapq.heappop(self.delayed)[2], now)
+                wait = self.delayed[0][0] - now if self.delayed else None
+                if self.ready:
+                    delay = self.bucket.delay(now)
+                    if not delay:
+                        share = heapq.heappop(self.ready)[2]
+                        ticket = share.queue.popleft()
+                        self.bucket.charge(ticket.size)
+                        share.bucket.charge(ticket.size)
+                        self.virtual_time = max(self.virtual_time, ticket.tag)
+                        if share.queue:
+                            self._schedule(share, now)
+                        elif not share.transfers and self.clients.get(share.address) is share:
+                            del self.clients[share.address]
+                        if self.metrics is not None:
+                            self.metrics.observe("pacing_wait_seconds", now - ticket.queued)
+                        ticket.granted = True
+                        ticket.wake()
+                        continue
+                    wait = delay if wait is None else min(wait, delay)
+                self.cond.wait(wait)